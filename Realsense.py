@@ -6,6 +6,17 @@ import orbslam2
 from scipy.signal import butter, lfilter, filtfilt
 import pyrealsense2 as rs
 import math
+import hashlib
+import json
+from filters import OnlineLowpass
+from sample_store import SampleStore, SAMPLE_DTYPE
+from binary_log import BinaryLog, TextLog, write_log, write_pose_text, poses_to_array
+from pose_transform import PoseTransform, retransform
+from segmentation import ColorSegmenter, BALL, GOAL
+from instrumentation import Instruments
+from depth_sampling import intrinsics_from_rs, extrinsics_from_rs, sample_depth, deproject, transform_points, \
+    color_to_depth_pixels, CameraIntrinsics
+from frame_source import RealsenseSource, SessionRecorder, RecordingSource
 
 class Realsense:
 
@@ -15,24 +26,50 @@ class Realsense:
 
         self.h, self.w = 480, 640
         self.slam = []
-        self.out = []
+        self.out = SampleStore()
         self.f = []
+        self.calibration = ''        # hash of the intrinsics and extrinsics, written in the header of the logs
+        self.binary_logs = False     # Data.log, trajectory.log (binary_log) instead of the text files
         self.pipeline = []
         self.point_3d = []
         self.point2_3d = []
-        self.goal_3d = []
+        self.goal_3d = SampleStore()
+        self.frame_time = 0.
+        # latest pose of the SLAM, and the ball and the goal in the world frame
+        self.world = PoseTransform()
+        self.detections = np.zeros((2, 3))
+        self.world_out = SampleStore()
+        self.world_goal = SampleStore()
         self.align = []
-        self.hsv = []
+        # ball and goal segmented together, once per frame
+        self.segmenter = ColorSegmenter((BALL, GOAL), erode=1, dilate=3)
+        self.instruments = Instruments(False)   # timers of the stages, instruments.enabled = True to measure
+        self.timings_file = 'timings'           # report of the timers (.json and .csv) at the end of a run
+        self.depth_scale = 0.001    # meters per unit of the depth image, read from the device
+        self.intrinsics = []        # of the color stream, the depth is aligned to it
+        self.disc_scale = 0.7       # fraction of the radius of the object where its depth is sampled
+        # without SLAM only the detected pixels are mapped to the depth image, instead of rs.align
+        self.sparse_align = True
+        self.depth_intrinsics = []
+        self.depth_to_color = []
+        self.color_to_depth = []
         # Filter requirements.
         self.order = 3
         self.fs = 60.0  # sample rate, Hz
         self.cutoff = 2.  # desired cutoff frequency of the filter, Hz
+        self.lag = 0      # samples of delay of the fixed lag smoother of the online filter, 0 for causal only
+        self.butter = None
+        self.lowpass = []
+        self.filtered = SampleStore()
 
     def butter_lowpass(self):
-        nyq = 0.5 * self.fs
-        normal_cutoff = self.cutoff / nyq
-        b, a = butter(self.order, normal_cutoff, btype='low', analog=False)
-        return b, a
+        # the coefficients only change with the filter requirements
+        if self.butter is None or self.butter[0] != (self.order, self.fs, self.cutoff):
+            nyq = 0.5 * self.fs
+            normal_cutoff = self.cutoff / nyq
+            b, a = butter(self.order, normal_cutoff, btype='low', analog=False)
+            self.butter = ((self.order, self.fs, self.cutoff), b, a)
+        return self.butter[1], self.butter[2]
 
     def butter_lowpass_filter(self, data):
         b, a = self.butter_lowpass()
@@ -40,18 +77,36 @@ class Realsense:
         y = filtfilt(b, a, data, padlen=50)
         return y
 
-    def Initialize_Realsense(self, slam_bool=False, file_capture=False):
-        # Configure depth and color streams
-        self.pipeline = rs.pipeline()
-        config = rs.config()
-        config.enable_stream(rs.stream.depth, self.w, self.h, rs.format.z16, 60)
-        config.enable_stream(rs.stream.color, self.w, self.h, rs.format.bgr8, 60)
-
-        # Start streaming
-        self.pipeline.start(config)
-
-        align_to = rs.stream.color
-        self.align = rs.align(align_to)
+    def Initialize_Realsense(self, slam_bool=False, file_capture=False, source=None):
+        # With a recorded session (source) the camera is not opened, the intrinsics come from the recording
+        if source is not None:
+            self.load_camera_metadata(source.metadata)
+        else:
+            # Configure depth and color streams
+            self.pipeline = rs.pipeline()
+            config = rs.config()
+            config.enable_stream(rs.stream.depth, self.w, self.h, rs.format.z16, 60)
+            config.enable_stream(rs.stream.color, self.w, self.h, rs.format.bgr8, 60)
+
+            # Start streaming
+            profile = self.pipeline.start(config)
+            self.depth_scale = profile.get_device().first_depth_sensor().get_depth_scale()
+            color_profile = profile.get_stream(rs.stream.color).as_video_stream_profile()
+            depth_profile = profile.get_stream(rs.stream.depth).as_video_stream_profile()
+            self.intrinsics = intrinsics_from_rs(color_profile.get_intrinsics())
+            self.depth_intrinsics = intrinsics_from_rs(depth_profile.get_intrinsics())
+            self.depth_to_color = extrinsics_from_rs(depth_profile.get_extrinsics_to(color_profile))
+            self.color_to_depth = extrinsics_from_rs(color_profile.get_extrinsics_to(depth_profile))
+
+            align_to = rs.stream.color
+            self.align = rs.align(align_to)
+
+        # identifies the calibration of the camera in the logs, like the calibration hash of Stereo
+        metadata = json.dumps(self.camera_metadata(), sort_keys=True)
+        self.calibration = hashlib.sha1(metadata.encode()).hexdigest()
+
+        # Filter of the 3d coordinates of the ball while they are collected
+        self.lowpass = OnlineLowpass(self.order, self.cutoff, self.fs, 3, self.lag)
 
         if slam_bool:
             vocab_path = "Parameters/ORBvoc.txt"
@@ -61,145 +116,163 @@ class Realsense:
             self.slam.initialize()
 
         if file_capture:
-            self.f = open("Data.txt", "w+")
-
-    def detect_ball(self, image, show=False):
-        # Part of the code to track the ball
-
-        self.hsv = cv.cvtColor(image, cv.COLOR_BGR2HSV)
-        mask = cv.inRange(self.hsv, (0, 100, 20), (20, 255, 255))
-        mask = cv.erode(mask, None, iterations=1)
-        mask = cv.dilate(mask, None, iterations=3)
-        cnts = cv.findContours(mask.copy(), cv.RETR_EXTERNAL,
-                               cv.CHAIN_APPROX_SIMPLE)[-2]
-
-        x, xc = 0, 0
-        y, yc = 0, 0
-        radius = 0
-        # only proceed if at least one contour was found
-        if len(cnts) > 0:
-            # find the largest contour in the mask, then use
-            # it to compute the minimum enclosing circle and
-            # centroid
-            c = max(cnts, key=cv.contourArea)
-            ((x, y), radius) = cv.minEnclosingCircle(c)
-
-            # only proceed if the radius meets a minimum size
-            if radius > 10:
-                # computing the centroid of the ball
-                M = cv.moments(c)
-                center = (int(M["m10"] / M["m00"]), int(M["m01"] / M["m00"]))
-                # draw the circle and centroid on the frame,
-                # then update the list of tracked points
-                cv.circle(image, (int(x), int(y)), int(radius), (0, 255, 255), 1)
-                cv.circle(image, center, 2, (0, 255, 255), -1)
-
-                xc = int(x)
-                yc = int(y)
+            if self.binary_logs:
+                # binary log of the samples, written by a background thread (log_to_text gives the text back)
+                self.f = BinaryLog("Data.log", SAMPLE_DTYPE, self.calibration, 'm')
+            else:
+                self.f = TextLog("Data.txt")
+
+    def filter_sample(self, tframe, point):
+        # online low pass of the ball, with lag > 0 the smoothed sample is the one of lag frames ago
+        smoothed = self.lowpass.step(point, tframe)
+        if smoothed is not None:
+            t, (x, y, z) = smoothed
+            self.filtered.append(t, x, y, z)
+
+    def camera_metadata(self, aligned=False):
+        # What a recorded session needs to be processed without the camera
+        def intrinsics(intr):
+            return {'width': intr.width, 'height': intr.height, 'fx': intr.fx, 'fy': intr.fy,
+                    'ppx': intr.ppx, 'ppy': intr.ppy, 'model': intr.model, 'coeffs': intr.coeffs.tolist()}
+        return {'depth_scale': self.depth_scale, 'aligned': aligned,
+                'intrinsics': intrinsics(self.intrinsics), 'depth_intrinsics': intrinsics(self.depth_intrinsics),
+                'depth_to_color': [m.tolist() for m in self.depth_to_color],
+                'color_to_depth': [m.tolist() for m in self.color_to_depth]}
+
+    def load_camera_metadata(self, metadata):
+        self.depth_scale = metadata['depth_scale']
+        self.intrinsics = CameraIntrinsics(**metadata['intrinsics'])
+        self.depth_intrinsics = CameraIntrinsics(**metadata['depth_intrinsics'])
+        self.depth_to_color = tuple(np.array(m) for m in metadata['depth_to_color'])
+        self.color_to_depth = tuple(np.array(m) for m in metadata['color_to_depth'])
+
+    def detect_targets(self, image, show=False):
+        # Part of the code to track the ball and the goal, both from one segmentation of the image
+        with self.instruments.timer('detect'):
+            targets = self.segmenter.detect(image)
+        for xc, yc, radius in targets.values():
+            # the frames of a replayed session are read only
+            if radius > 0 and image.flags.writeable:
+                cv.circle(image, (xc, yc), radius, (0, 255, 255), 1)
+                cv.circle(image, (xc, yc), 2, (0, 255, 255), -1)
 
         if show:
-            cv.imshow('Image_', mask)
+            cv.imshow('Image_', self.segmenter.mask)
             cv.moveWindow('Image_', 100, 200)
+        return targets
 
-        return xc, yc, int(radius)
+    def detect_ball(self, image, show=False):
+        return self.detect_targets(image, show)['ball']
 
     def detect_goal(self, image, show=False):
-        # Part of the code to track the goal
-        mask_g = cv.inRange(self.hsv, (40, 100, 40), (90, 255, 255))
-        mask_g = cv.erode(mask_g, None, iterations=1)
-        mask_g = cv.dilate(mask_g, None, iterations=3)
-        cnts = cv.findContours(mask_g.copy(), cv.RETR_EXTERNAL,
-                               cv.CHAIN_APPROX_SIMPLE)[-2]
-
-        x, xc = 0, 0
-        y, yc = 0, 0
-        radius = 0
-        # only proceed if at least one contour was found
-        if len(cnts) > 0:
-            # find the largest contour in the mask, then use
-            # it to compute the minimum enclosing circle and
-            # centroid
-            c = max(cnts, key=cv.contourArea)
-            ((x, y), radius) = cv.minEnclosingCircle(c)
-            # only proceed if the radius meets a minimum size
-            if radius > 10:
-                # computing the centroid of the goal
-                M = cv.moments(c)
-                center = (int(M["m10"] / M["m00"]), int(M["m01"] / M["m00"]))
-                # draw the circle and centroid on the frame,
-                # then update the list of tracked points
-                cv.circle(image, (int(x), int(y)), int(radius), (0, 255, 255), 1)
-                cv.circle(image, center, 2, (0, 255, 255), -1)
-                xc = int(x)
-                yc = int(y)
-
-        if show:
-            cv.imshow('Image_Goal', mask_g)
-            cv.moveWindow('Image_Goal', 800, 200)
-        return xc, yc, int(radius)
-
-    def transform_disp_3d(self, xc, yc, depth_frame, depth_intrin):
-        depth = depth_frame.get_distance(xc, yc)
-        point_3d = rs.rs2_deproject_pixel_to_point(depth_intrin, [xc, yc], depth)
-        return point_3d
+        return self.detect_targets(image, show)['goal']
+
+    def transform_disp_3d(self, targets, depth_image):
+        # 3d points (meters) of all the targets (xc, yc, radius) at once, with the median depth of a
+        # disc of their radius. A target not detected (radius 0) or without depth gives an empty list
+        targets = np.asarray(targets, np.float64).reshape(-1, 3)
+        depth = sample_depth(depth_image, targets, self.depth_scale, self.disc_scale)
+        points = deproject(self.intrinsics, targets[:, :2], depth)
+        return [point.tolist() if d > 0 and radius > 0 else [] for point, d, radius in zip(points, depth, targets[:, 2])]
+
+    def transform_sparse_3d(self, targets, depth_image):
+        # Same as transform_disp_3d with the depth image not aligned to the color one: only the
+        # targets are mapped to the depth image, their depth is sampled there (disc scaled by the
+        # ratio of the focal lengths) and the points are moved to the frame of the color camera
+        targets = np.asarray(targets, np.float64).reshape(-1, 3)
+        pixels, found = color_to_depth_pixels(targets[:, :2], depth_image, self.depth_scale, self.depth_intrinsics,
+                                              self.intrinsics, self.depth_to_color, self.color_to_depth)
+        radii = targets[:, 2] * self.depth_intrinsics.fx / self.intrinsics.fx
+        depth = sample_depth(depth_image, np.column_stack((pixels, radii)), self.depth_scale, self.disc_scale)
+        points = transform_points(self.depth_to_color, deproject(self.depth_intrinsics, pixels, depth))
+        return [point.tolist() if ok and d > 0 and radius > 0 else []
+                for point, ok, d, radius in zip(points, found, depth, targets[:, 2])]
 
     def collect_single_frame_data(self, frames, start, show=False, file_capture=False):
         # This function gets the 3d coordinates of the basketball for one frame, to be called inside a loop
 
-        # Align the depth frame to color frame
-        aligned_frames = self.align.process(frames)
-        # Get aligned frames
-        depth_frame = aligned_frames.get_depth_frame()  # aligned_depth_frame is a 640x480 depth image
-        color_frame = aligned_frames.first(rs.stream.color)
+        if self.sparse_align:
+            # the depth image stays in the depth camera, only the targets are mapped to it
+            depth_frame = frames.get_depth_frame()
+            color_frame = frames.get_color_frame()
+        else:
+            # Align the depth frame to color frame
+            with self.instruments.timer('align'):
+                aligned_frames = self.align.process(frames)
+            # Get aligned frames
+            depth_frame = aligned_frames.get_depth_frame()  # aligned_depth_frame is a 640x480 depth image
+            color_frame = aligned_frames.first(rs.stream.color)
 
         # Convert images to numpy arrays
         depth_image = np.asanyarray(depth_frame.get_data())
         color_image = np.asanyarray(color_frame.get_data())
 
-        # Intrinsics & Extrinsics
-        depth_intrin = depth_frame.profile.as_video_stream_profile().intrinsics
+        tframe = time.time() - start
+        self.process_images(color_image, depth_image, tframe, show, file_capture, not self.sparse_align)
 
-        # Apply colormap on depth image (image must be converted to 8-bit per pixel first)
-        depth_colormap = cv.applyColorMap(cv.convertScaleAbs(depth_image, alpha=0.03), cv.COLORMAP_JET)
-        xc, yc, _ = self.detect_ball(color_image, show)
-        xg, yg, _ = self.detect_goal(color_image, show)
+    def process_images(self, color_image, depth_image, tframe, show=False, file_capture=False, aligned=False):
+        # 3d coordinates of the ball and the goal from the colour and depth images of one frame,
+        # aligned tells if the depth image is aligned to the colour one
+        targets = self.detect_targets(color_image, show)
+        ball, goal = targets['ball'], targets['goal']
 
         # Transform these 2d coordinates into 3d
-        self.point_3d = self.transform_disp_3d(xc, yc, depth_frame, depth_intrin)
-        self.point2_3d = self.transform_disp_3d(xg, yg, depth_frame, depth_intrin)
-
-        # if we want to save the values in a file
-        if file_capture:
-            self.f.write("{}, {}, {}, {} \n".format(self.point_3d[0], self.point_3d[1],
-                                                    self.point_3d[2]))
-
-        if self.point2_3d:
-            self.goal_3d.append([self.point2_3d[0], self.point2_3d[1], self.point2_3d[2]])
-
-        if self.point_3d:
-            self.out.append([self.point_3d[0], self.point_3d[1], self.point_3d[2]])
+        with self.instruments.timer('depth'):
+            if aligned:
+                self.point_3d, self.point2_3d = self.transform_disp_3d((ball, goal), depth_image)
+            else:
+                self.point_3d, self.point2_3d = self.transform_sparse_3d((ball, goal), depth_image)
+
+        with self.instruments.timer('logging'):
+            # if we want to save the values in a file
+            if file_capture and self.point_3d:
+                self.f.write(tframe, self.point_3d[0], self.point_3d[1], self.point_3d[2])
+
+            if self.point2_3d:
+                self.goal_3d.append(tframe, self.point2_3d[0], self.point2_3d[1], self.point2_3d[2])
+
+            if self.point_3d:
+                self.out.append(tframe, self.point_3d[0], self.point_3d[1], self.point_3d[2])
+                self.filter_sample(tframe, self.point_3d)
+        self.instruments.count('frames')
+        if not self.point_3d:
+            self.instruments.count('frames_without_ball')
 
         if show:
+            # Apply colormap on depth image (image must be converted to 8-bit per pixel first)
+            depth_colormap = cv.applyColorMap(cv.convertScaleAbs(depth_image, alpha=0.03), cv.COLORMAP_JET)
             # Stack both images horizontally
             images = np.hstack((color_image, depth_colormap))
             cv.imshow('RealSense',images)
 
-    def collect_frames_data(self, num_frames, show=False, file_capture=False):
+    def collect_frames_data(self, num_frames, show=False, file_capture=False, source=None):
         # This part of the code give you the matrix of 3d coordinates of the ball for X frames
+        # source is a recorded session (frame_source.SessionSource) to process instead of the camera
 
         # Start by initializing the mapping and disparity
-        self.Initialize_Realsense()
+        self.Initialize_Realsense(source=source)
+        if source is None:
+            source = RealsenseSource(self.pipeline, None if self.sparse_align else self.align)
+            aligned, skip = not self.sparse_align, 50
+        else:
+            aligned, skip = source.metadata['aligned'], -1
+        source.start()
 
         # Start a counter to measure fps
         start = time.time()
 
         for frame in range(num_frames):
             # Wait for a coherent pair of frames: depth and color
-            frames = self.pipeline.wait_for_frames()
-            if frame > 50:
-                self.collect_single_frame_data(frames, start, show, file_capture)
+            with self.instruments.timer('capture'):
+                ret, color_image, depth_image = source.read()
+            if not ret:
+                break
+            # the first frames of the camera are skipped, the exposure is not settled yet
+            if frame > skip:
+                self.process_images(color_image, depth_image, source.timestamp - start, show, file_capture, aligned)
             if cv.waitKey(1) & 0xFF == ord('q'):
                 break
+        source.stop()
 
         # End time
         end = time.time()
@@ -211,33 +284,57 @@ class Realsense:
         # Calculate frames per second
         fps = num_frames / seconds
         print("Estimated frames per second : {0}".format(fps))
+        self.report_timings()
 
-        return self.out
+        return self.out.as_array(('x', 'y', 'z'))
+
+    def record(self, path, num_frames, aligned=False):
+        # Record the colour and depth frames of the camera (depth aligned to the colour or not) with
+        # their timestamps and the intrinsics, to process them later with collect_frames_data
+        self.Initialize_Realsense()
+        recorder = SessionRecorder(path, ('color', 'depth'), metadata=self.camera_metadata(aligned))
+        source = RecordingSource(RealsenseSource(self.pipeline, self.align if aligned else None), recorder).start()
+        for frame in range(num_frames):
+            ret, _, _ = source.read()
+            if not ret:
+                break
+        source.stop()
+
+    def report_timings(self, path=None):
+        # Print the timers of the stages and write them to path.json and path.csv (self.timings_file by default)
+        if not self.instruments.enabled:
+            return
+        if path is None:
+            path = self.timings_file
+        self.instruments.print_report()
+        self.instruments.export_json(path + '.json')
+        self.instruments.export_csv(path + '.csv')
 
     def plot_charts(self):
         # Funtion to plot the 3d coordinates
-        self.out = np.array(self.out)
-        self.goal_3d = np.array(self.goal_3d)
+        out = self.out.as_array(('x', 'y', 'z'))
+        goal_3d = self.goal_3d.as_array(('x', 'y', 'z'))
+        filtered = self.filtered.as_array(('x', 'y', 'z'))
         # plt.figure('time')
         # plt.plot(self.out[:, 0], label='3D')
         # plt.legend(loc='upper left')
         plt.figure('x cm')
         #y1 = self.butter_lowpass_filter(self.out[:, 1])
-        plt.plot(self.out[:, 0]*100, label='3D')
-        plt.plot(self.goal_3d[:, 0]*100, label='3D_goal')
-        #plt.plot(y1, label='3D filtered')
+        plt.plot(out[:, 0]*100, label='3D')
+        plt.plot(goal_3d[:, 0]*100, label='3D_goal')
+        plt.plot(filtered[:, 0]*100, label='3D filtered online')
         plt.legend(loc='upper left')
         plt.figure('y cm')
         #y2 = self.butter_lowpass_filter(self.out[:, 2])
-        plt.plot(self.out[:, 1]*100, label='3D')
-        plt.plot(self.goal_3d[:, 1]*100, label='3D_goal')
-        #plt.plot(y2, label='3D filtered')
+        plt.plot(out[:, 1]*100, label='3D')
+        plt.plot(goal_3d[:, 1]*100, label='3D_goal')
+        plt.plot(filtered[:, 1]*100, label='3D filtered online')
         plt.legend(loc='upper left')
         plt.figure('z cm')
         #y3 = self.butter_lowpass_filter(self.out[:, 3])
-        plt.plot(self.out[:, 2]*100, label='3D')
-        plt.plot(self.goal_3d[:, 2]*100, label='3D_goal')
-        #plt.plot(y3, label='3D filtered')
+        plt.plot(out[:, 2]*100, label='3D')
+        plt.plot(goal_3d[:, 2]*100, label='3D_goal')
+        plt.plot(filtered[:, 2]*100, label='3D filtered online')
         plt.legend(loc='upper left')
         plt.show()
 
@@ -247,53 +344,32 @@ class Realsense:
             self.f.close()
 
         cv.destroyAllWindows()
-        self.pipeline.stop()
+        if self.pipeline:
+            self.pipeline.stop()
+
+    def save_poses(self, filename, points):
+        # TIME t r00 ... t2 text, or with binary_logs the binary log of the poses (log_to_text gives the text back)
+        if self.binary_logs:
+            write_log(filename, poses_to_array(points), self.calibration, 'm')
+        else:
+            write_pose_text(filename, points)
 
     def save_trajectory(self, filename):
-        with open(filename, 'w') as traj_file:
-            traj_file.writelines(
-                ' TIME {time} {r00} {r01} {r02} {t0} {r10} {r11} {r12} {t1} {r20} {r21} {r22} {t2}\n'.format(
-                    time=repr(t),
-                    r00=repr(r00),
-                    r01=repr(r01),
-                    r02=repr(r02),
-                    t0=repr(t0),
-                    r10=repr(r10),
-                    r11=repr(r11),
-                    r12=repr(r12),
-                    t1=repr(t1),
-                    r20=repr(r20),
-                    r21=repr(r21),
-                    r22=repr(r22),
-                    t2=repr(t2)
-                ) for t, r00, r01, r02, t0, r10, r11, r12, t1, r20, r21, r22, t2 in self.slam.get_trajectory_points())
+        self.save_poses(filename, self.slam.get_trajectory_points())
 
     def save_keyframe(self, filename):
-        with open(filename, 'w') as traj_file:
-            traj_file.writelines(
-                ' TIME {time} {r00} {r01} {r02} {t0} {r10} {r11} {r12} {t1} {r20} {r21} {r22} {t2}\n'.format(
-                    time=repr(t),
-                    r00=repr(r00),
-                    r01=repr(r01),
-                    r02=repr(r02),
-                    t0=repr(t0),
-                    r10=repr(r10),
-                    r11=repr(r11),
-                    r12=repr(r12),
-                    t1=repr(t1),
-                    r20=repr(r20),
-                    r21=repr(r21),
-                    r22=repr(r22),
-                    t2=repr(t2)
-                ) for t, r00, r01, r02, t0, r10, r11, r12, t1, r20, r21, r22, t2 in self.slam.get_keyframe_points())
+        self.save_poses(filename, self.slam.get_keyframe_points())
 
     def SLAM_single_cycle(self, frames, start, show = False):
+        # the RGB-D SLAM needs the whole depth image aligned to the color one
         t = time.time()
         seconds = t - start
         tframe = seconds
+        self.frame_time = tframe
 
         # Align the depth frame to color frame
-        aligned_frames = self.align.process(frames)
+        with self.instruments.timer('align'):
+            aligned_frames = self.align.process(frames)
         # Get aligned frames
         depth_frame = aligned_frames.get_depth_frame()  # aligned_depth_frame is a 640x480 depth image
         color_frame = aligned_frames.first(rs.stream.color)
@@ -302,21 +378,20 @@ class Realsense:
         depth_image = np.asanyarray(depth_frame.get_data())
         color_image = np.asanyarray(color_frame.get_data())
 
-        # Intrinsics & Extrinsics
-        depth_intrin = depth_frame.profile.as_video_stream_profile().intrinsics
-
-        xc, yc, _ = self.detect_ball(color_image, show)
-        xg, yg, _ = self.detect_goal(color_image, show)
+        targets = self.detect_targets(color_image, show)
+        ball, goal = targets['ball'], targets['goal']
 
         # Transform these 2d coordinates into 3d
-        self.point_3d = self.transform_disp_3d(xc, yc, depth_frame, depth_intrin)
-        self.point2_3d = self.transform_disp_3d(xg, yg, depth_frame, depth_intrin)
+        with self.instruments.timer('depth'):
+            self.point_3d, self.point2_3d = self.transform_disp_3d((ball, goal), depth_image)
 
-        if self.point2_3d:
-            self.goal_3d.append([self.point2_3d[0], self.point2_3d[1], self.point2_3d[2]])
+        with self.instruments.timer('logging'):
+            if self.point2_3d:
+                self.goal_3d.append(tframe, self.point2_3d[0], self.point2_3d[1], self.point2_3d[2])
 
-        if self.point_3d:
-            self.out.append([self.point_3d[0], self.point_3d[1], self.point_3d[2]])
+            if self.point_3d:
+                self.out.append(tframe, self.point_3d[0], self.point_3d[1], self.point_3d[2])
+                self.filter_sample(tframe, self.point_3d)
 
         if show:
             depth_colormap = cv.applyColorMap(cv.convertScaleAbs(depth_image, alpha=0.03), cv.COLORMAP_JET)
@@ -329,6 +404,7 @@ class Realsense:
         t2 = time.time()
 
         ttrack = t2 - t1
+        self.instruments.record('slam', ttrack)
         return ttrack
 
     def SLAM(self, num_frames, show = False):
@@ -340,38 +416,29 @@ class Realsense:
         start = time.time()
 
         times_track = [0 for _ in range(num_frames)]
+        # the live world positions need the current pose alone from the binding, the plots
+        # use the final trajectory in any case
+        live_world = PoseTransform.supported(self.slam)
+        if not live_world:
+            print('No get_current_pose in the orbslam2 binding, no live world positions')
         print('-----')
         print('Start processing sequence ...')
-        glob_XX = []
-        glob_YY = []
-        glob_ZZ = []
-        glob_GX = []
-        glob_GY = []
-        glob_GZ = []
 
         for idx in range(num_frames):
-            frames = self.pipeline.wait_for_frames()
+            with self.instruments.timer('capture'):
+                frames = self.pipeline.wait_for_frames()
             # Wait for a coherent pair of frames: depth and color
             if idx>50:
                 times_track[idx] = self.SLAM_single_cycle(frames, start, show)
-                current_traj = self.slam.get_trajectory_points()
-                out = np.array(self.out)
-                goal = np.array(self.goal_3d)
-                current_traj = np.array(current_traj)
-
-                glob_XX.append((out[-1, 0]*current_traj[-1, 1]) + (out[-1, 1]*current_traj[-1, 2])
-                              + (out[-1, 2]*current_traj[-1,3]) + current_traj[-1,4])
-                glob_YY.append((out[-1, 0]*current_traj[-1, 5]) + (out[-1, 1]*current_traj[-1, 6])
-                              + (out[-1, 2]*current_traj[-1,7]) + current_traj[-1,8])
-                glob_ZZ.append((out[-1, 0]*current_traj[-1, 9]) + (out[-1, 1]*current_traj[-1, 10])
-                              + (out[-1, 2]*current_traj[-1,11]) + current_traj[-1,12])
-
-                glob_GX.append((goal[-1, 0]*current_traj[-1, 1]) + (goal[-1, 1]*current_traj[-1, 2])
-                              + (goal[-1, 2]*current_traj[-1,3]) + current_traj[-1,4])
-                glob_GY.append((goal[-1, 0]*current_traj[-1, 5]) + (goal[-1, 1]*current_traj[-1, 6])
-                              + (goal[-1, 2]*current_traj[-1,7]) + current_traj[-1,8])
-                glob_GZ.append((goal[-1, 0]*current_traj[-1, 9]) + (goal[-1, 1]*current_traj[-1, 10])
-                              + (goal[-1, 2]*current_traj[-1,11]) + current_traj[-1,12])
+                # ball and goal of this frame to the world frame with the latest pose, in one product
+                if live_world and self.world.update(self.slam):
+                    self.detections[0] = self.point_3d or np.nan
+                    self.detections[1] = self.point2_3d or np.nan
+                    ball, goal = self.world.transform(self.detections)
+                    if self.point_3d:
+                        self.world_out.append(self.frame_time, *ball)
+                    if self.point2_3d:
+                        self.world_goal.append(self.frame_time, *goal)
             if cv.waitKey(1) & 0xFF == ord('q'):
                 break
 
@@ -385,26 +452,29 @@ class Realsense:
         fps = num_frames / seconds
         print("Estimated frames per second : {0}".format(fps))
 
-        self.save_trajectory('trajectory.txt')
-        # self.save_keyframe('keyframe.txt')
+        extension = '.log' if self.binary_logs else '.txt'
+        self.save_trajectory('trajectory' + extension)
+        # self.save_keyframe('keyframe' + extension)
 
         trajec = self.slam.get_trajectory_points()
         trajec = np.array(trajec)
 
-        self.out = np.array(self.out)
-
-        glob_X = np.array(glob_XX)
-        glob_Y = np.array(glob_YY)
-        glob_Z = np.array(glob_ZZ)
-        glob_GX = np.array(glob_GX)
-        glob_GY = np.array(glob_GY)
-        glob_GZ = np.array(glob_GZ)
+        # the whole history again with the final trajectory, optimized by the loop closures
+        final = poses_to_array(trajec)
+        glob_X, glob_Y, glob_Z = retransform(final, self.out['t'], self.out.as_array(('x', 'y', 'z'))).T
+        glob_GX, glob_GY, glob_GZ = retransform(final, self.goal_3d['t'], self.goal_3d.as_array(('x', 'y', 'z'))).T
 
         self.slam.shutdown()
         plt.figure('slam')
         plt.plot(trajec[:, 4], trajec[:, 12], 'b', label='Stereo system')
         plt.plot(glob_X, glob_Z, 'g', label='3D global', marker='*')
         plt.plot(glob_GX, glob_GZ, 'r', label='3D goal', marker='*')
+        if live_world:
+            # the same with the pose known at the time of the frame, before the loop closures
+            live_ball = self.world_out.as_array(('x', 'y', 'z'))
+            live_goal = self.world_goal.as_array(('x', 'y', 'z'))
+            plt.plot(live_ball[:, 0], live_ball[:, 2], 'g--', label='3D global live')
+            plt.plot(live_goal[:, 0], live_goal[:, 2], 'r--', label='3D goal live')
         #plt.legend(loc=2)
 
         times_track = sorted(times_track)
@@ -412,6 +482,7 @@ class Realsense:
         print('-----')
         print('median tracking time: {0}'.format(times_track[num_frames // 2]))
         print('mean tracking time: {0}'.format(total_time / num_frames))
+        self.report_timings()
         plt.show()
 
         return 0
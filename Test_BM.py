@@ -6,17 +6,15 @@ from matplotlib import pyplot as plt
 from sklearn.preprocessing import normalize
 import time
 import datetime
+import os
 from disparity_fisheye import Stereo
+from stereo_matching import sgbm_parameters, StripDisparity, create_stereo_matcher, load_matcher_config
 from scipy.signal import butter, lfilter, filtfilt
 
 # def CallBackFunc(event, x, y, flags, param):
 	# if event == cv.EVENT_LBUTTONDOWN:
 		# print("Left button of the mouse is clicked - position (", x, ", ",y,",  RGB:", (100*fx * baseline) / (units * displ[y,x]) , ")")
 
-def nothing(x):
-  pass
-
-
 # Filter requirements.
 order = 3
 fs = 30.0  # sample rate, Hz
@@ -35,8 +33,6 @@ def butter_lowpass_filter(data):
 	y = filtfilt(b, a, data, padlen=25)
 	return y
 
-cv.namedWindow('Colorbars')
-
 # cv.namedWindow('Disparity Map')
 # cv.setMouseCallback('Disparity Map', CallBackFunc)
 
@@ -49,16 +45,24 @@ _uniquenessRatio=3
 _speckleWindowSize=5
 _speckleRange=2
 _preFilterCap=55
-
-cv.createTrackbar("window_size", "Colorbars",7,255,nothing)
-cv.createTrackbar("_minDisparity", "Colorbars",6,255,nothing)
-cv.createTrackbar("a", "Colorbars",6,255,nothing)
-cv.createTrackbar("_blockSize", "Colorbars",7,50,nothing)
-cv.createTrackbar("_disp12MaxDiff", "Colorbars",30,250,nothing)
-cv.createTrackbar("_uniquenessRatio", "Colorbars",1,50,nothing)
-cv.createTrackbar("_speckleWindowSize", "Colorbars",5,20,nothing)
-cv.createTrackbar("_speckleRange", "Colorbars",1,20,nothing)
-cv.createTrackbar("_preFilterCap", "Colorbars",0,255,nothing)
+matcher_name = 'sgbm_3way'
+strips = 1         # number of horizontal strips computed in parallel, 1 to use the matcher directly
+
+# The configuration chosen by tune_sgbm.py replaces the values above (and the trackbars)
+params_file = 'Parameters/sgbm_params.json'
+if os.path.exists(params_file):
+	config = load_matcher_config(params_file)
+	matcher_name = config['matcher']
+	window_size = config['window_size']
+	_minDisparity = config['minDisparity']
+	a = config['a']
+	_blockSize = config['blockSize']
+	_disp12MaxDiff = config['disp12MaxDiff']
+	_uniquenessRatio = config['uniquenessRatio']
+	_speckleWindowSize = config['speckleWindowSize']
+	_speckleRange = config['speckleRange']
+	_preFilterCap = config['preFilterCap']
+	print("Matcher {0} from {1}".format(matcher_name, params_file))
 
 
 cap = cv.VideoCapture(0)
@@ -101,30 +105,11 @@ map1l, map2l = cv.fisheye.initUndistortRectifyMap(K_l, D_l, R_l, P_l, (w,h), cv.
 map1r, map2r = cv.fisheye.initUndistortRectifyMap(K_r, D_r, R_r, P_r, (w,h), cv.CV_32FC1)
 #map1r, map2r = cv.initUndistortRectifyMap(K_r, D_r, R_r, P_r, (w,h), cv.CV_32FC1)
 
-left_matcher = cv.StereoSGBM_create(
-	minDisparity=-_minDisparity,
-	numDisparities=16*a,             # max_disp has to be dividable by 16 f. E. HH 192, 256
-	blockSize=_blockSize,
-	P1=8 * 3 * window_size ** 2,    # wsize default 3; 5; 7 for SGBM reduced size image; 15 for SGBM full size image (1300px and above); 5 Works nicely
-	P2=32 * 3 * window_size ** 2,
-	disp12MaxDiff=_disp12MaxDiff,
-	uniquenessRatio=_uniquenessRatio,
-	speckleWindowSize=_speckleWindowSize,
-	speckleRange=_speckleRange,
-	preFilterCap=_preFilterCap,
-	mode=cv.STEREO_SGBM_MODE_SGBM_3WAY)
-
-right_matcher = cv.ximgproc.createRightMatcher(left_matcher)
-
-
-# FILTER Parameters
-lmbda = 80000
-sigma = 1.3
-visual_multiplier = 1.0
-
-wls_filter = cv.ximgproc.createDisparityWLSFilter(matcher_left=left_matcher)
-wls_filter.setLambda(lmbda)
-wls_filter.setSigmaColor(sigma)
+params = sgbm_parameters(window_size, _minDisparity, a, _blockSize, _disp12MaxDiff,
+						 _uniquenessRatio, _speckleWindowSize, _speckleRange, _preFilterCap)
+# 'sgbm_wls' for the SGBM of both images smoothed by the WLS filter
+left_matcher = create_stereo_matcher(matcher_name, params)
+strip_matcher = StripDisparity(params, strips, matcher = matcher_name)
 
 # ret, frame = cap1.read()
 # ret1, frame1 = cap.read()
@@ -163,30 +148,10 @@ for frames in range(num_frames):
 	imgL=cv.cvtColor(imgL, cv.COLOR_BGR2GRAY)
 	imgR=cv.cvtColor(imgR, cv.COLOR_BGR2GRAY)
 	
-	window_size=cv.getTrackbarPos("window_size", "Colorbars")
-	_minDisparity=cv.getTrackbarPos("_minDisparity", "Colorbars")
-	a=cv.getTrackbarPos("a", "Colorbars")
-	_blockSize=cv.getTrackbarPos("_blockSize", "Colorbars")
-	_disp12MaxDiff=cv.getTrackbarPos("_disp12MaxDiff", "Colorbars")
-	_uniquenessRatio=cv.getTrackbarPos("_uniquenessRatio", "Colorbars")
-	_speckleWindowSize=cv.getTrackbarPos("_speckleWindowSize", "Colorbars")
-	_speckleRange=cv.getTrackbarPos("_speckleRange", "Colorbars")
-	_preFilterCap=cv.getTrackbarPos("_preFilterCap", "Colorbars")
-	
-	left_matcher = cv.StereoSGBM_create(
-	minDisparity=-_minDisparity,
-	numDisparities=16*a,             # max_disp has to be dividable by 16 f. E. HH 192, 256
-	blockSize=_blockSize,
-	P1=8 * 3 * window_size ** 2,    # wsize default 3; 5; 7 for SGBM reduced size image; 15 for SGBM full size image (1300px and above); 5 Works nicely
-	P2=32 * 3 * window_size ** 2,
-	disp12MaxDiff=_disp12MaxDiff,
-	uniquenessRatio=_uniquenessRatio,
-	speckleWindowSize=_speckleWindowSize,
-	speckleRange=_speckleRange,
-	preFilterCap=_preFilterCap,
-	mode=cv.STEREO_SGBM_MODE_SGBM_3WAY)
-	
-	displ = left_matcher.compute(imgL, imgR).astype(np.float32)/16
+	if strips > 1:
+		displ = strip_matcher.compute(imgL, imgR).astype(np.float32)/16
+	else:
+		displ = left_matcher.compute(imgL, imgR).astype(np.float32)/16
 	#dispr = right_matcher.compute(imgR, imgL).astype(np.float32)/16
 
 	displ = np.int16(displ)
@@ -348,6 +313,7 @@ graph = np.array(graph)
 # When everything done, release the capture
 cap.release()
 cap1.release()
+strip_matcher.close()
 cv.destroyAllWindows()
 #f.close()
 plt.figure('x cm')
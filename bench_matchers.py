@@ -0,0 +1,118 @@
+import cv2 as cv
+import numpy as np
+import argparse
+import time
+from disparity_fisheye import Stereo
+from stereo_matching import MATCHERS, REFERENCE_MATCHERS, create_stereo_matcher, compare_disparity
+from bench_strips import load_pairs
+
+# Speed and accuracy of the matchers of stereo_matching.MATCHERS on the same pairs: ms/frame,
+# density and error against the ground truth of synthetic pairs, or against a reference matcher
+# on recorded pairs, and the fastest matcher within the error target. Run from the root of the repository:
+#   python bench_matchers.py --synthetic 10
+#   python bench_matchers.py --pairs 20 --roi-rows 60 --max-error 0.05
+
+
+def synthetic_pairs(count, w, h, params, seed = 0):
+	# Random texture seen at a constant disparity with a disc (the ball) closer to the cameras.
+	# Returns the pairs and the exact disparities (int16, *16) of the left images
+	rng = np.random.RandomState(seed)
+	background = params['minDisparity'] + params['numDisparities'] // 4
+	ball = params['minDisparity'] + params['numDisparities'] // 2
+	pairs, truths = [], []
+	xs, ys = np.meshgrid(np.arange(w, dtype=np.float32), np.arange(h, dtype=np.float32))
+	for _ in range(count):
+		right = cv.GaussianBlur(rng.randint(0, 256, (h, w)).astype(np.uint8), (3, 3), 0)
+		xc, yc, radius = rng.randint(w // 4, 3 * w // 4), rng.randint(h // 4, 3 * h // 4), rng.randint(15, 40)
+		disparity = np.full((h, w), background, np.float32)
+		disparity[(xs - xc) ** 2 + (ys - yc) ** 2 <= radius ** 2] = ball
+		# the left pixel x is the right pixel x - d
+		left = cv.remap(right, xs - disparity, ys, cv.INTER_LINEAR, borderMode=cv.BORDER_REFLECT)
+		pairs.append((left, right))
+		truths.append(np.int16(disparity * 16))
+	return pairs, truths
+
+
+def time_compute(matcher, pairs, repeat, roi = None):
+	matcher.compute(pairs[0][0], pairs[0][1], roi)   # warm up (buffers, numba compilation)
+	t0 = time.perf_counter()
+	for _ in range(repeat):
+		for imgL, imgR in pairs:
+			matcher.compute(imgL, imgR, roi)
+	return (time.perf_counter() - t0) / (repeat * len(pairs))
+
+
+def evaluate(matcher, pairs, references, repeat, min_disparity, roi = None):
+	# ms/frame and the mean of compare_disparity against the references over the pairs
+	elapsed = time_compute(matcher, pairs, repeat, roi)
+	errors = []
+	for (imgL, imgR), reference in zip(pairs, references):
+		if roi is not None:
+			x0, y0, x1, y1 = roi
+			reference = reference[y0:y1, x0:x1]
+		errors.append(compare_disparity(reference, matcher.compute(imgL, imgR, roi), min_disparity))
+	result = dict((key, float(np.mean([e[key] for e in errors]))) for key in errors[0])
+	result['ms'] = 1000 * elapsed
+	return result
+
+
+def fastest(results, max_error, reference = None):
+	# name of the fastest matcher with at most max_error of pixels wrong by more than 1 px. The
+	# reference matchers are only there to compare with, and the matcher taken as the truth
+	# (reference) has no error against itself
+	accepted = [(result['ms'], name) for name, result in results.items()
+				if result['bad_1px'] <= max_error and name not in REFERENCE_MATCHERS and name != reference]
+	return min(accepted)[1] if accepted else None
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--images', default='Calibration/Fisheye/Images_calibration')
+	parser.add_argument('--calibration', default='Parameters/fish_final_calib.npz')
+	parser.add_argument('--pairs', type=int, default=20)
+	parser.add_argument('--synthetic', type=int, default=0, help='number of synthetic pairs with a known disparity instead of the images')
+	parser.add_argument('--repeat', type=int, default=3)
+	parser.add_argument('--matchers', nargs='+', default=sorted(MATCHERS))
+	parser.add_argument('--reference', default='sgbm_3way', help='matcher taken as the truth on recorded pairs')
+	parser.add_argument('--roi-rows', type=int, default=0, help='match only a band of rows in the middle of the images')
+	parser.add_argument('--max-error', type=float, default=0.05, help='accuracy target, fraction of pixels wrong by more than 1 px')
+	args = parser.parse_args()
+
+	stereo = Stereo(args.calibration)
+	params = stereo.matcher_parameters()
+	if args.synthetic:
+		pairs, references = synthetic_pairs(args.synthetic, stereo.w, stereo.h, params)
+	else:
+		stereo.Initialize_mapping_calibration(disparity_bool = False)
+		pairs = load_pairs(args.images, args.pairs, stereo)
+		if not pairs:
+			raise SystemExit("No left_*.png / right_*.png pairs in {0}".format(args.images))
+		reference = create_stereo_matcher(args.reference, params)
+		references = [reference.compute(imgL, imgR) for imgL, imgR in pairs]
+
+	h, w = pairs[0][0].shape[:2]
+	roi = None
+	if args.roi_rows:
+		roi = (0, max(0, (h - args.roi_rows) // 2), w, min(h, (h + args.roi_rows) // 2))
+	print("{0} {1} pairs {2}x{3}{4}, error against {5}".format(
+		len(pairs), 'synthetic' if args.synthetic else 'recorded', w, h,
+		", roi of {0} rows".format(roi[3] - roi[1]) if roi else '', 'the truth' if args.synthetic else args.reference))
+	print("{0:<10} {1:>10} {2:>8} {3:>11} {4:>8}".format('matcher', 'ms/frame', 'density', 'mean error', '>1px'))
+
+	results = {}
+	for name in args.matchers:
+		try:
+			matcher = create_stereo_matcher(name, params)
+		except ImportError as error:
+			print("{0:<10} skipped: {1}".format(name, error))
+			continue
+		results[name] = result = evaluate(matcher, pairs, references, args.repeat, params['minDisparity'], roi)
+		print("{0:<10} {1:>10.2f} {2:>7.1f}% {3:>11.3f} {4:>7.1f}%{5}".format(
+			name, result['ms'], 100*result['density'], result['mean_error'], 100*result['bad_1px'],
+			'  (reference)' if name in REFERENCE_MATCHERS else ''))
+
+	best = fastest(results, args.max_error, None if args.synthetic else args.reference)
+	if best:
+		print("Fastest within {0:.1%} of pixels wrong by more than 1 px: {1}".format(args.max_error, best))
+	else:
+		print("No matcher within {0:.1%} of pixels wrong by more than 1 px".format(args.max_error))
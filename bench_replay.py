@@ -0,0 +1,153 @@
+import cv2 as cv
+import numpy as np
+import argparse
+import glob
+import json
+import os
+import resource
+import sys
+import time
+from disparity_fisheye import Stereo
+from frame_source import SessionSource
+
+# Replay of recorded stereo pairs through Stereo.collect_single_frame_data at maximum speed, no camera
+# needed. Reports the fps, the latency percentiles of the frames and of every stage, and the peak
+# memory, and compares them with a baseline. Run from the root of the repository:
+#   python bench_replay.py --save-baseline bench_baseline.json
+#   python bench_replay.py --baseline bench_baseline.json --threshold 0.15
+
+
+def load_frames(folder, num_pairs = None):
+	# Raw (not rectified) left / right frames of a folder with left_*.png and right_*.png or of a
+	# recorded session, all in memory so the disk is not part of the measure
+	pairs = []
+	if os.path.exists(os.path.join(folder, 'session.json')):
+		session = SessionSource(folder)
+		for _ in range(min(len(session), num_pairs or len(session))):
+			_, left, right = session.read()
+			pairs.append((np.array(left), np.array(right)))
+		return pairs
+	for left_path in sorted(glob.glob(os.path.join(folder, 'left_*.png')))[:num_pairs]:
+		right_path = left_path.replace('left_', 'right_')
+		if not os.path.exists(right_path):
+			continue
+		pairs.append((cv.imread(left_path), cv.imread(right_path)))
+	return pairs
+
+
+def peak_memory_mb():
+	# peak resident memory of the process, ru_maxrss is in kB on Linux and in bytes on macOS
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	return peak / (1024. * 1024.) if sys.platform == 'darwin' else peak / 1024.
+
+
+def replay(stereo, pairs, mode, repeat = 1, warmup = 2):
+	# Runs the pairs repeat times in one mode, returns the report of the instruments with the
+	# end to end figures
+	stereo.Initialize_mapping_calibration(disparity_bool = mode != 'sparse', slam_bool = False)
+	instruments = stereo.instruments
+	instruments.enabled = True
+	start = time.time()
+	for left, right in pairs[:warmup]:
+		stereo.collect_single_frame_data(left, right, start, False, False, mode)
+	instruments.reset()
+
+	t0 = time.perf_counter()
+	for _ in range(repeat):
+		for left, right in pairs:
+			frame_start = time.perf_counter()
+			stereo.collect_single_frame_data(left, right, start, False, False, mode)
+			instruments.record('frame', time.perf_counter() - frame_start)
+	elapsed = time.perf_counter() - t0
+
+	report = instruments.report()
+	report['fps'] = repeat * len(pairs) / elapsed
+	report['peak_memory_mb'] = peak_memory_mb()
+	return report
+
+
+def compare(results, baseline, threshold, min_ms = 0.5, min_mb = 16.):
+	# Regressions beyond threshold (relative): lower fps, higher p50 / p95 of the frames and stages
+	# and higher peak memory. A time or a memory has also to grow by more than min_ms / min_mb, the
+	# stages of a few microseconds jitter by much more than threshold from one run to the next
+	regressions = []
+	for mode, result in results.items():
+		if mode not in baseline:
+			continue
+		base = baseline[mode]
+		if result['fps'] < base['fps'] * (1 - threshold):
+			regressions.append("{0}: fps {1:.1f} < {2:.1f}".format(mode, result['fps'], base['fps']))
+		for stage, summary in result['stages'].items():
+			if stage not in base['stages']:
+				continue
+			for key in ('p50_ms', 'p95_ms'):
+				reference = base['stages'][stage][key]
+				if summary[key] > reference * (1 + threshold) and summary[key] - reference > min_ms:
+					regressions.append("{0}/{1}: {2} {3:.3f} ms > {4:.3f} ms".format(
+						mode, stage, key, summary[key], reference))
+		# peak of the whole process, so a mode also carries the memory of the modes run before it
+		reference = base.get('peak_memory_mb')
+		if reference is not None and result['peak_memory_mb'] > reference * (1 + threshold) \
+				and result['peak_memory_mb'] - reference > min_mb:
+			regressions.append("{0}: peak memory {1:.0f} MB > {2:.0f} MB".format(mode, result['peak_memory_mb'], reference))
+	return regressions
+
+
+def print_results(results):
+	for mode, result in results.items():
+		frame = result['stages']['frame']
+		print("--- {0}: {1:.1f} fps, frame p50 {2:.2f} ms, p95 {3:.2f} ms, p99 {4:.2f} ms, peak memory {5:.0f} MB".format(
+			mode, result['fps'], frame['p50_ms'], frame['p95_ms'], frame['p99_ms'], result['peak_memory_mb']))
+		print("{0:<18} {1:>8} {2:>9} {3:>9} {4:>9} {5:>9}".format('stage', 'count', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms'))
+		for stage in sorted(result['stages']):
+			s = result['stages'][stage]
+			print("{0:<18} {1:>8} {2:>9.3f} {3:>9.3f} {4:>9.3f} {5:>9.3f}".format(
+				stage, s['count'], s['p50_ms'], s['p95_ms'], s['p99_ms'], s['max_ms']))
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--images', default='Calibration/Fisheye/Images_calibration',
+						help='folder with left_*.png / right_*.png, calibration images or a recorded session')
+	parser.add_argument('--calibration', default='Parameters/fish_final_calib.npz')
+	parser.add_argument('--pairs', type=int, default=None)
+	parser.add_argument('--repeat', type=int, default=1)
+	parser.add_argument('--modes', nargs='+', default=['full', 'roi', 'temporal', 'sparse'])
+	parser.add_argument('--cv-threads', type=int, default=None, help='cv.setNumThreads, 1 for stable figures')
+	parser.add_argument('--baseline', default=None, help='json of a previous run to compare with')
+	parser.add_argument('--threshold', type=float, default=0.10, help='relative regression that fails the run')
+	parser.add_argument('--min-ms', type=float, default=0.5, help='smallest increase of a latency that counts as a regression')
+	parser.add_argument('--min-mb', type=float, default=16., help='smallest increase of the peak memory that counts as a regression')
+	parser.add_argument('--save-baseline', default=None, help='write the results as the new baseline')
+	parser.add_argument('--output', default=None, help='write the results to this json file')
+	args = parser.parse_args()
+
+	if args.cv_threads is not None:
+		cv.setNumThreads(args.cv_threads)
+
+	pairs = load_frames(args.images, args.pairs)
+	if not pairs:
+		raise SystemExit("No left_*.png / right_*.png pairs in {0}".format(args.images))
+	print("{0} pairs {1}x{2}, repeated {3} times".format(len(pairs), pairs[0][0].shape[1], pairs[0][0].shape[0], args.repeat))
+
+	results = {}
+	for mode in args.modes:
+		# a new Stereo per mode so the tracks and the samples of a mode do not leak into the next one
+		results[mode] = replay(Stereo(args.calibration), pairs, mode, args.repeat)
+	print_results(results)
+
+	for path in (args.output, args.save_baseline):
+		if path:
+			with open(path, 'w') as results_file:
+				json.dump(results, results_file, indent=2, sort_keys=True)
+
+	if args.baseline:
+		with open(args.baseline) as baseline_file:
+			baseline = json.load(baseline_file)
+		regressions = compare(results, baseline, args.threshold, args.min_ms, args.min_mb)
+		if regressions:
+			print("Regressions beyond {0:.0%}:".format(args.threshold))
+			for regression in regressions:
+				print("  " + regression)
+			sys.exit(1)
+		print("No regression beyond {0:.0%} against {1}".format(args.threshold, args.baseline))
@@ -0,0 +1,81 @@
+import cv2 as cv
+import numpy as np
+import argparse
+import glob
+import os
+import time
+from disparity_fisheye import Stereo
+from stereo_matching import MATCHERS, create_stereo_matcher, compare_disparity, StripDisparity
+
+# Scaling of the strip parallel SGBM against the number of cores, on the calibration images
+# or on any folder with left_*.png / right_*.png pairs. The seam error is measured against the
+# same matcher on the full images: 'changed' is the fraction of the pixels with another value,
+# '>1px' the fraction of the pixels valid in both that are off by more than 1 px. Run from the
+# root of the repository:
+#   python bench_strips.py --pairs 20 --repeat 3
+#   python bench_strips.py --matcher sgbm --overlap 32
+
+
+def load_pairs(folder, num_pairs, stereo):
+	# Rectified gray pairs, copied because the rectifier reuses its buffers
+	pairs = []
+	for left_path in sorted(glob.glob(os.path.join(folder, 'left_*.png')))[:num_pairs]:
+		right_path = left_path.replace('left_', 'right_')
+		if not os.path.exists(right_path):
+			continue
+		imgL, imgR, _, _ = stereo.rectifier.rectify(cv.imread(left_path), cv.imread(right_path), color_left = False)
+		pairs.append((imgL.copy(), imgR.copy()))
+	return pairs
+
+
+def time_matcher(matcher, pairs, repeat):
+	matcher.compute(pairs[0][0], pairs[0][1])   # warm up (pool, buffers)
+	t0 = time.perf_counter()
+	for _ in range(repeat):
+		for imgL, imgR in pairs:
+			matcher.compute(imgL, imgR)
+	return (time.perf_counter() - t0) / (repeat * len(pairs))
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--images', default='Calibration/Fisheye/Images_calibration')
+	parser.add_argument('--calibration', default='Parameters/fish_final_calib.npz')
+	parser.add_argument('--pairs', type=int, default=20)
+	parser.add_argument('--repeat', type=int, default=3)
+	parser.add_argument('--overlap', type=int, default=None, help='rows shared by two strips, StripDisparity default otherwise')
+	parser.add_argument('--matcher', default='sgbm_3way', choices=sorted(MATCHERS))
+	parser.add_argument('--processes', action='store_true', help='process pool instead of threads')
+	parser.add_argument('--cv-threads', type=int, default=None, help='cv.setNumThreads, 1 to disable OpenCV threading')
+	args = parser.parse_args()
+
+	if args.cv_threads is not None:
+		cv.setNumThreads(args.cv_threads)
+
+	stereo = Stereo(args.calibration)
+	stereo.Initialize_mapping_calibration(disparity_bool = False)
+	pairs = load_pairs(args.images, args.pairs, stereo)
+	if not pairs:
+		raise SystemExit("No left_*.png / right_*.png pairs in {0}".format(args.images))
+	params = stereo.matcher_parameters()
+
+	matcher = create_stereo_matcher(args.matcher, params)
+	reference = [matcher.compute(imgL, imgR) for imgL, imgR in pairs]
+	base = time_matcher(matcher, pairs, args.repeat)
+	print("{0} pairs, {1} cores, {2}".format(len(pairs), os.cpu_count(), args.matcher))
+	print("{0:>8} {1:>8} {2:>10} {3:>8} {4:>8} {5:>8}".format('strips', 'overlap', 'ms/frame', 'speedup', 'changed', '>1px'))
+	print("{0:>8} {1:>8} {2:>10.2f} {3:>8.2f} {4:>8} {5:>8}".format('matcher', '-', 1000*base, 1., '-', '-'))
+
+	workers = 1
+	while workers <= (os.cpu_count() or 1):
+		strip_matcher = StripDisparity(params, workers, args.overlap, workers, args.processes, matcher = args.matcher)
+		elapsed = time_matcher(strip_matcher, pairs, args.repeat)
+		# seams against the full image matcher
+		disparities = [strip_matcher.compute(imgL, imgR) for imgL, imgR in pairs]
+		changed = np.mean([np.mean(disp != ref) for disp, ref in zip(disparities, reference)])
+		bad = np.mean([compare_disparity(ref, disp, params['minDisparity'])['bad_1px']
+					   for disp, ref in zip(disparities, reference)])
+		strip_matcher.close()
+		print("{0:>8} {1:>8} {2:>10.2f} {3:>8.2f} {4:>7.2f}% {5:>7.2f}%".format(
+			workers, strip_matcher.overlap, 1000*elapsed, base/elapsed, 100*changed, 100*bad))
+		workers *= 2
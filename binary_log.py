@@ -0,0 +1,161 @@
+import numpy as np
+import ast
+import json
+import os
+import threading
+from queue import Queue
+from sample_store import SAMPLE_DTYPE
+
+# Binary log of fixed size records (detections, poses): a text header of HEADER_SIZE bytes with
+# the dtype, the calibration hash and the units, then the raw records. The number of records
+# comes from the size of the file, so the file can be appended to and read with np.memmap
+# while it is written, and a run that crashes keeps everything already written
+
+MAGIC = b'SVLOG1\n'
+HEADER_SIZE = 512
+
+# A pose of the SLAM, the same 13 values as a line of trajectory.txt (TIME t r00 ... t2)
+POSE_DTYPE = np.dtype([('t', 'f8'), ('pose', 'f8', (3, 4))])
+
+
+def make_header(dtype, calibration = '', units = 'mm'):
+	info = json.dumps({'dtype': repr(np.dtype(dtype).descr), 'calibration': calibration, 'units': units})
+	header = MAGIC + info.encode()
+	if len(header) >= HEADER_SIZE:
+		raise ValueError("The header of the log is too long")
+	return header + b' ' * (HEADER_SIZE - len(header) - 1) + b'\n'
+
+
+def read_header(path):
+	# dict with the dtype, the calibration hash and the units of a log
+	with open(path, 'rb') as log_file:
+		header = log_file.read(HEADER_SIZE)
+	if not header.startswith(MAGIC):
+		raise ValueError("{0} is not a binary log".format(path))
+	info = json.loads(header[len(MAGIC):].decode())
+	info['dtype'] = np.dtype(ast.literal_eval(info['dtype']))
+	return info
+
+
+def load_log(path):
+	# (header, records), the records are memory mapped so even millions of poses load instantly
+	info = read_header(path)
+	count = (os.path.getsize(path) - HEADER_SIZE) // info['dtype'].itemsize
+	if count == 0:
+		return info, np.zeros(0, info['dtype'])
+	return info, np.memmap(path, dtype=info['dtype'], mode='r', offset=HEADER_SIZE, shape=(count,))
+
+
+def write_log(path, records, calibration = '', units = 'mm'):
+	# Write a whole array of records at once, for the logs written at the end of a run
+	records = np.ascontiguousarray(records)
+	with open(path, 'wb') as log_file:
+		log_file.write(make_header(records.dtype, calibration, units))
+		records.tofile(log_file)
+
+
+def write_pose_text(path, points):
+	# The text layout of trajectory.txt / keyframe.txt, one ' TIME t r00 ... t2' line per pose
+	with open(path, 'w') as traj_file:
+		traj_file.writelines(' TIME ' + ' '.join(repr(value) for value in point) + '\n' for point in points)
+
+
+class TextLog:
+	# The comma separated text of Data.txt (t, x, y, z), with the write / close of BinaryLog
+
+	def __init__(self, path, columns = 4):
+		self.file = open(path, 'w+')
+		self.columns = columns
+
+	def write(self, *values):
+		self.file.write(', '.join('{}'.format(value) for value in values[:self.columns]) + ' \n')
+
+	def close(self):
+		self.file.close()
+
+
+def poses_to_array(points):
+	# The list of (t, r00, ..., t2) of orbslam2 (get_trajectory_points) as POSE_DTYPE records
+	poses = np.asarray(points, np.float64).reshape(-1, 13)
+	return np.ascontiguousarray(poses).view(POSE_DTYPE).reshape(-1)
+
+
+class BinaryLog:
+	# Log written by a background thread. write() only copies the record in a preallocated chunk,
+	# the full chunks go to the thread that writes them to the file, and come back to be reused
+
+	def __init__(self, path, dtype = SAMPLE_DTYPE, calibration = '', units = 'mm', chunk = 256):
+		self.path = path
+		self.dtype = np.dtype(dtype)
+		self.chunk = chunk
+		self.log_file = open(path, 'wb')
+		self.log_file.write(make_header(self.dtype, calibration, units))
+		self.pending = Queue()
+		self.free = Queue()
+		self.buffer = np.zeros(chunk, self.dtype)
+		self.count = 0              # records in the current chunk
+		self.written = 0
+		self.thread = threading.Thread(target=self._writer, name='BinaryLog')
+		self.thread.daemon = True
+		self.thread.start()
+
+	def _writer(self):
+		while True:
+			item = self.pending.get()
+			if item is None:
+				break
+			buffer, count = item
+			buffer[:count].tofile(self.log_file)
+			self.written += count
+			self.free.put(buffer)
+		self.log_file.close()
+
+	def _swap(self):
+		self.pending.put((self.buffer, self.count))
+		self.buffer = np.zeros(self.chunk, self.dtype) if self.free.empty() else self.free.get()
+		self.count = 0
+
+	def write(self, *values):
+		# one record, values in the order of the fields (the missing ones are 0)
+		if len(values) < len(self.dtype.names):
+			values = values + (0,) * (len(self.dtype.names) - len(values))
+		self.buffer[self.count] = values
+		self.count += 1
+		if self.count == self.chunk:
+			self._swap()
+
+	def write_many(self, records):
+		# array of records of the same dtype
+		done = 0
+		while done < len(records):
+			n = min(self.chunk - self.count, len(records) - done)
+			self.buffer[self.count:self.count + n] = records[done:done + n]
+			self.count += n
+			done += n
+			if self.count == self.chunk:
+				self._swap()
+
+	def close(self):
+		if self.count:
+			self._swap()
+		self.pending.put(None)
+		self.thread.join()
+
+
+def text_to_log(text_path, log_path, calibration = '', units = 'm'):
+	# trajectory.txt / keyframe.txt (TIME t r00 ... t2) to a binary log of poses
+	values = np.loadtxt(text_path, usecols=range(1, 14), ndmin=2)
+	write_log(log_path, poses_to_array(values), calibration, units)
+
+
+def log_to_text(log_path, text_path):
+	# A log of poses back to the TIME t r00 ... t2 layout, with all the digits of the doubles.
+	# Any other log is written as comma separated columns, like Data.txt
+	info, records = load_log(log_path)
+	if info['dtype'] == POSE_DTYPE:
+		values = np.asarray(records).view(np.float64).reshape(-1, 13)
+		np.savetxt(text_path, values, fmt=' TIME' + ' %.17g' * 13)
+	else:
+		names = info['dtype'].names
+		values = np.column_stack([records[name] for name in names]) if len(records) else np.zeros((0, len(names)))
+		np.savetxt(text_path, values, fmt='%.9g', delimiter=', ', header=', '.join(names))
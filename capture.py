@@ -0,0 +1,151 @@
+import time
+import threading
+from collections import deque
+
+
+class CameraGrabber(threading.Thread):
+	# One thread per camera, it keeps grabbing frames so the camera buffer never
+	# fills up and stores only the latest few in a small ring
+
+	def __init__(self, capture, ring_size = 2, condition = None):
+		threading.Thread.__init__(self)
+		self.daemon = True
+		self.capture = capture
+		self.ring = deque(maxlen=ring_size)
+		self.condition = condition if condition is not None else threading.Condition()
+		# set before the thread starts so a stop() that comes first is not lost
+		self.running = True
+		self.seq = 0
+		self.failed = 0
+
+	def run(self):
+		while self.running:
+			# grab() only latches the frame, the timestamp is taken right after it so
+			# it is as close as possible to the exposure. The decode happens in retrieve()
+			if not self.capture.grab():
+				self.failed += 1
+				time.sleep(0.001)
+				continue
+			timestamp = time.monotonic()
+			ret, frame = self.capture.retrieve()
+			if not ret:
+				self.failed += 1
+				continue
+			with self.condition:
+				self.seq += 1
+				self.ring.append((timestamp, self.seq, frame))
+				self.condition.notify_all()
+
+	def stop(self):
+		self.running = False
+
+
+class StereoCapture:
+	# Pairs the frames of the two grabbers by their capture timestamp.
+	# read() has the same return as cv.VideoCapture.read but with both images
+
+	def __init__(self, capture_left, capture_right, max_skew = None, ring_size = 2, timeout = 1.0, fps = 30., retries = 5):
+		# seconds, maximum time difference accepted for a pair. Free running cameras are up to half
+		# a frame period apart, so that is the default
+		self.max_skew = max_skew if max_skew is not None else 0.5 / fps
+		self.timeout = timeout
+		self.retries = retries        # timeouts in a row before read() gives up
+		self.timeouts = 0
+		self.condition = threading.Condition()
+		self.left = CameraGrabber(capture_left, ring_size, self.condition)
+		self.right = CameraGrabber(capture_right, ring_size, self.condition)
+		self.last_left = 0
+		self.last_right = 0
+		self.timestamp = 0.
+		self.skew = 0.                # skew of the last pair returned
+		self.max_skew_seen = 0.
+		self.sum_skew = 0.
+		self.pairs = 0
+		self.dropped_pairs = 0
+
+	def start(self):
+		self.left.start()
+		self.right.start()
+		return self
+
+	def _best_pair(self):
+		# look for the closest pair of frames that has not been used yet
+		best = None
+		for tl, sl, fl in self.left.ring:
+			if sl <= self.last_left:
+				continue
+			for tr, sr, fr in self.right.ring:
+				if sr <= self.last_right:
+					continue
+				skew = abs(tl - tr)
+				if best is None or skew < best[0]:
+					best = (skew, tl, sl, fl, tr, sr, fr)
+		return best
+
+	def read(self):
+		for attempt in range(self.retries + 1):
+			result = self._read_pair()
+			if result is not None:
+				return result
+			self.timeouts += 1
+			if attempt == self.retries or not (self.left.is_alive() and self.right.is_alive()):
+				break
+			print("No pair of frames within {0} ms in {1} s (failed grabs: {2} left, {3} right), retrying".format(
+				1000*self.max_skew, self.timeout, self.left.failed, self.right.failed))
+		print("Stereo capture stopped: no pair of frames after {0} timeouts".format(attempt + 1))
+		return False, None, None
+
+	def _read_pair(self):
+		# next pair within max_skew, None after timeout seconds without one
+		deadline = time.monotonic() + self.timeout
+		with self.condition:
+			while True:
+				best = self._best_pair()
+				if best is not None:
+					skew, tl, sl, fl, tr, sr, fr = best
+					if skew <= self.max_skew:
+						break
+					# The pair is too far apart, the older frame will never find a partner
+					# so we skip it and wait for the next one
+					self.dropped_pairs += 1
+					if tl < tr:
+						self.last_left = sl
+					else:
+						self.last_right = sr
+					continue
+				remaining = deadline - time.monotonic()
+				if remaining <= 0:
+					return None
+				self.condition.wait(remaining)
+
+			self.last_left = sl
+			self.last_right = sr
+
+		self.timestamp = 0.5 * (tl + tr)
+		self.skew = tl - tr
+		self.max_skew_seen = max(self.max_skew_seen, abs(self.skew))
+		self.sum_skew += abs(self.skew)
+		self.pairs += 1
+		return True, fl, fr
+
+	def mean_skew(self):
+		if self.pairs == 0:
+			return 0.
+		return self.sum_skew / self.pairs
+
+	def stats(self):
+		return {'pairs': self.pairs,
+				'dropped_pairs': self.dropped_pairs,
+				'timeouts': self.timeouts,
+				'skew': self.skew,
+				'mean_skew': self.mean_skew(),
+				'max_skew': self.max_skew_seen,
+				'failed_left': self.left.failed,
+				'failed_right': self.right.failed}
+
+	def stop(self):
+		# stop the threads, the cameras themselves are released by the owner
+		self.left.stop()
+		self.right.stop()
+		self.left.join(self.timeout)
+		self.right.join(self.timeout)
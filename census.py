@@ -0,0 +1,122 @@
+import cv2 as cv
+import numpy as np
+try:
+	import numba
+except ImportError:
+	# the cost volume is computed with numpy without it, a few times slower
+	numba = None
+
+# Census transform matcher: every pixel is described by the bits "darker than the centre" of its
+# window, the cost of a disparity is the hamming distance between the descriptors, summed over a
+# block and the best one wins. It is a reference backend, to compare the errors of the other
+# matchers with a cost that does not depend on the brightness of the images: even on the band of
+# rows around the ball (60 rows) it is about 15 times slower than SGBM_3WAY, the cost volume
+# (numDisparities x rows x columns) and its aggregation are not fused like in OpenCV. The roi is
+# cut before the census so only the band is ever computed
+
+
+# number of set bits of every byte
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], np.uint8)
+
+
+def census_transform(image, window = 5):
+	# uint32 descriptor of every pixel (window*window - 1 <= 32 bits), the border is replicated
+	if window * window - 1 > 32:
+		raise ValueError("The census window has at most 32 bits, window <= 5")
+	r = window // 2
+	h, w = image.shape[:2]
+	padded = cv.copyMakeBorder(image, r, r, r, r, cv.BORDER_REPLICATE)
+	census = np.zeros((h, w), np.uint32)
+	for dy in range(window):
+		for dx in range(window):
+			if dy == r and dx == r:
+				continue
+			census <<= 1
+			census |= padded[dy:dy + h, dx:dx + w] < image
+	return census
+
+
+def _numpy_costs(census_left, census_right, min_disparity, num_disparities, max_cost):
+	h, w = census_left.shape
+	costs = np.full((num_disparities, h, w), max_cost, np.uint8)
+	for i in range(num_disparities):
+		d = min_disparity + i
+		if abs(d) >= w:
+			continue
+		if d >= 0:
+			x = np.bitwise_xor(census_left[:, d:], census_right[:, :w - d])
+			costs[i, :, d:] = _POPCOUNT[x.view(np.uint8)].reshape(h, w - d, 4).sum(axis=2)
+		else:
+			x = np.bitwise_xor(census_left[:, :w + d], census_right[:, -d:])
+			costs[i, :, :w + d] = _POPCOUNT[x.view(np.uint8)].reshape(h, w + d, 4).sum(axis=2)
+	return costs
+
+
+if numba is not None:
+	@numba.njit(parallel=True, cache=True)
+	def _numba_costs(census_left, census_right, min_disparity, num_disparities, max_cost):
+		h, w = census_left.shape
+		costs = np.full((num_disparities, h, w), max_cost, np.uint8)
+		for i in numba.prange(num_disparities):
+			d = min_disparity + i
+			for y in range(h):
+				for x in range(max(0, d), min(w, w + d)):
+					v = census_left[y, x] ^ census_right[y, x - d]
+					count = 0
+					while v:
+						v &= v - np.uint32(1)
+						count += 1
+					costs[i, y, x] = count
+		return costs
+else:
+	_numba_costs = None
+
+
+class CensusMatcher:
+	# compute() returns the int16 (disparity*16) image of the OpenCV matchers, the pixels without
+	# a match at (minDisparity - 1)*16
+
+	def __init__(self, params, window = 5, use_numba = True):
+		self.min_disparity = params['minDisparity']
+		self.num_disparities = params['numDisparities']
+		self.block_size = max(3, params['blockSize'] | 1)
+		self.uniqueness = params['uniquenessRatio'] / 100.
+		self.window = window
+		self.costs = _numba_costs if use_numba and _numba_costs is not None else _numpy_costs
+
+	def compute(self, left, right, roi = None):
+		if roi is not None:
+			x0, y0, x1, y1 = roi
+			left, right = left[y0:y1, x0:x1], right[y0:y1, x0:x1]
+		if left.ndim == 3:
+			left, right = cv.cvtColor(left, cv.COLOR_BGR2GRAY), cv.cvtColor(right, cv.COLOR_BGR2GRAY)
+		max_cost = self.window * self.window - 1
+		costs = self.costs(census_transform(left, self.window), census_transform(right, self.window),
+						   self.min_disparity, self.num_disparities, max_cost)
+		# aggregation over the block, one box filter per disparity
+		block = (self.block_size, self.block_size)
+		aggregated = np.empty(costs.shape, np.float32)
+		for i in range(self.num_disparities):
+			cv.boxFilter(costs[i], cv.CV_32F, block, dst=aggregated[i], normalize=False)
+
+		best = np.argmin(aggregated, axis=0)
+		rows, cols = np.indices(best.shape)
+		best_cost = aggregated[best, rows, cols]
+		# sub pixel disparity from the parabola through the costs around the best one
+		inside = (best > 0) & (best < self.num_disparities - 1)
+		before = aggregated[np.maximum(best - 1, 0), rows, cols]
+		after = aggregated[np.minimum(best + 1, self.num_disparities - 1), rows, cols]
+		curvature = before + after - 2 * best_cost
+		offset = np.where(inside & (curvature > 0), (before - after) / (2 * np.maximum(curvature, 1e-6)), 0.)
+		disparity = np.round((self.min_disparity + best + offset) * 16).astype(np.int16)
+
+		# uniqueness: the best cost outside the neighbours of the winner has to be higher by the ratio
+		for shift in (-1, 0, 1):
+			index = np.clip(best + shift, 0, self.num_disparities - 1)
+			aggregated[index, rows, cols] = np.inf
+		second = aggregated.min(axis=0)
+		invalid = second * (1 - self.uniqueness) < best_cost
+		# the left columns can not be matched with every disparity of the range, like SGBM
+		invalid[:, :max(0, self.min_disparity + self.num_disparities)] = True
+		disparity[invalid] = (self.min_disparity - 1) * 16
+		return disparity
@@ -0,0 +1,148 @@
+import numpy as np
+import warnings
+
+# Depth of the detected objects from the depth image as a NumPy array, and deprojection of many
+# pixels at once with the same model as rs2_deproject_pixel_to_point. Nothing here needs the
+# realsense binding, the intrinsics and extrinsics are read once from the stream profiles
+
+MODELS = ('none', 'brown_conrady', 'inverse_brown_conrady')
+
+
+class CameraIntrinsics:
+
+	def __init__(self, width, height, fx, fy, ppx, ppy, model = 'none', coeffs = (0., 0., 0., 0., 0.)):
+		if model not in MODELS:
+			raise ValueError("Unsupported distortion model {0}".format(model))
+		self.width, self.height = width, height
+		self.fx, self.fy = fx, fy
+		self.ppx, self.ppy = ppx, ppy
+		self.model = model
+		self.coeffs = np.asarray(coeffs, np.float64)
+
+
+def intrinsics_from_rs(intrin):
+	# rs.intrinsics (stream profile) to CameraIntrinsics, the model is rs.distortion.<name>
+	model = str(intrin.model).split('.')[-1]
+	return CameraIntrinsics(intrin.width, intrin.height, intrin.fx, intrin.fy, intrin.ppx, intrin.ppy,
+							model, intrin.coeffs)
+
+
+def sample_depth(depth_image, targets, depth_scale, scale = 0.7, max_samples = 32):
+	# Robust depth (meters) of the targets (k x 3: xc, yc, radius): median of the non zero pixels
+	# in a disc of scale * radius, so the edges of the ball (background) and the holes of the depth
+	# image do not count. The disc is sampled on a grid of at most max_samples pixels per side.
+	# 0 for a target without any valid pixel
+	targets = np.asarray(targets, np.float64).reshape(-1, 3)
+	h, w = depth_image.shape[:2]
+	radii = np.maximum(targets[:, 2] * scale, 1.)
+	r_max = int(np.ceil(radii.max()))
+	step = max(1, int(np.ceil(2. * r_max / max_samples)))
+	d = np.arange(-(r_max // step) * step, r_max + 1, step)
+	dx, dy = np.meshgrid(d, d)
+	dx, dy = dx.ravel(), dy.ravel()
+	inside = dx ** 2 + dy ** 2 <= radii[:, None] ** 2
+	xs = np.rint(targets[:, 0:1]).astype(np.intp) + dx
+	ys = np.rint(targets[:, 1:2]).astype(np.intp) + dy
+	inside &= (xs >= 0) & (xs < w) & (ys >= 0) & (ys < h)
+	values = depth_image[np.clip(ys, 0, h - 1), np.clip(xs, 0, w - 1)].astype(np.float64)
+	values[~inside | (values == 0)] = np.nan
+	with warnings.catch_warnings():
+		# all nan for the targets without depth
+		warnings.simplefilter('ignore', RuntimeWarning)
+		depth = np.nanmedian(values, axis=1)
+	return np.nan_to_num(depth) * depth_scale
+
+
+def _brown_conrady(x, y, c):
+	# Brown-Conrady model applied to the normalized coordinates
+	r2 = x * x + y * y
+	f = 1 + c[0] * r2 + c[1] * r2 * r2 + c[4] * r2 * r2 * r2
+	return (x * f + 2 * c[2] * x * y + c[3] * (r2 + 2 * x * x),
+			y * f + 2 * c[3] * x * y + c[2] * (r2 + 2 * y * y))
+
+
+def deproject(intrinsics, pixels, depth):
+	# k x 2 pixels and k depths to the k x 3 points of the camera, like rs2_deproject_pixel_to_point
+	pixels = np.asarray(pixels, np.float64).reshape(-1, 2)
+	x = (pixels[:, 0] - intrinsics.ppx) / intrinsics.fx
+	y = (pixels[:, 1] - intrinsics.ppy) / intrinsics.fy
+	c = intrinsics.coeffs
+	if intrinsics.model == 'inverse_brown_conrady':
+		# the coefficients undistort, so they are applied directly
+		x, y = _brown_conrady(x, y, c)
+	elif intrinsics.model == 'brown_conrady':
+		# the coefficients distort, the undistortion is iterative (same 10 iterations as librealsense)
+		x0, y0 = x, y
+		for _ in range(10):
+			r2 = x * x + y * y
+			icdist = 1. / (1 + ((c[4] * r2 + c[1]) * r2 + c[0]) * r2)
+			xq, yq = x / icdist, y / icdist
+			delta_x = 2 * c[2] * xq * yq + c[3] * (r2 + 2 * xq * xq)
+			delta_y = 2 * c[3] * xq * yq + c[2] * (r2 + 2 * yq * yq)
+			x = (x0 - delta_x) * icdist
+			y = (y0 - delta_y) * icdist
+	depth = np.asarray(depth, np.float64).reshape(-1)
+	return np.column_stack((x * depth, y * depth, depth))
+
+
+def project(intrinsics, points):
+	# k x 3 points of the camera to the k x 2 pixels, like rs2_project_point_to_pixel
+	points = np.asarray(points, np.float64).reshape(-1, 3)
+	with np.errstate(divide='ignore', invalid='ignore'):
+		x = points[:, 0] / points[:, 2]
+		y = points[:, 1] / points[:, 2]
+	c = intrinsics.coeffs
+	if intrinsics.model == 'brown_conrady':
+		x, y = _brown_conrady(x, y, c)
+	elif intrinsics.model == 'inverse_brown_conrady':
+		# the coefficients undistort, fixed point iteration to distort
+		x0, y0 = x, y
+		for _ in range(10):
+			xu, yu = _brown_conrady(x, y, c)
+			x, y = x + x0 - xu, y + y0 - yu
+	return np.column_stack((x * intrinsics.fx + intrinsics.ppx, y * intrinsics.fy + intrinsics.ppy))
+
+
+def extrinsics_from_rs(extrin):
+	# rs.extrinsics to (R, t), the rotation of the binding is stored column by column
+	return np.array(extrin.rotation, np.float64).reshape(3, 3).T, np.array(extrin.translation, np.float64)
+
+
+def transform_points(extrinsics, points):
+	R, t = extrinsics
+	return np.asarray(points, np.float64).reshape(-1, 3).dot(R.T) + t
+
+
+def color_to_depth_pixels(pixels, depth_image, depth_scale, depth_intrinsics, color_intrinsics,
+						  depth_to_color, color_to_depth, min_depth = 0.1, max_depth = 10., max_error = 4.):
+	# Pixels of the depth image that see the k color pixels, without aligning the whole image
+	# (same idea as rs2_project_color_pixel_to_depth_pixel). The pixel of the depth image lies on the
+	# segment where the color pixel projects for min_depth..max_depth. Every pixel of the segment is
+	# deprojected with its own depth and projected back to the color image, the closest to the
+	# color pixel wins. Returns the k x 2 pixels and the mask of the ones found within max_error
+	pixels = np.asarray(pixels, np.float64).reshape(-1, 2)
+	k = len(pixels)
+	h, w = depth_image.shape[:2]
+	ends = []
+	for depth in (min_depth, max_depth):
+		points = transform_points(color_to_depth, deproject(color_intrinsics, pixels, np.full(k, depth)))
+		ends.append(project(depth_intrinsics, points))
+	start, end = ends
+	# one step per pixel of the longest segment, bounded if a segment leaves the image far away
+	length = np.nan_to_num(np.max(np.abs(end - start)), nan=w, posinf=w)
+	steps = int(np.ceil(min(length, w + h))) + 1
+	s = np.linspace(0., 1., steps)
+	candidates = start[:, None, :] + s[None, :, None] * (end - start)[:, None, :]       # k x steps x 2
+	us = np.rint(candidates[:, :, 0]).astype(np.intp)
+	vs = np.rint(candidates[:, :, 1]).astype(np.intp)
+	inside = (us >= 0) & (us < w) & (vs >= 0) & (vs < h)
+	us, vs = np.clip(us, 0, w - 1), np.clip(vs, 0, h - 1)
+	depth = depth_image[vs, us].astype(np.float64) * depth_scale
+	points = transform_points(depth_to_color, deproject(depth_intrinsics, np.column_stack((us.ravel(), vs.ravel())),
+														depth.ravel()))
+	error = np.linalg.norm(project(color_intrinsics, points) - np.repeat(pixels, steps, axis=0), axis=1).reshape(k, steps)
+	error[~inside | (depth == 0)] = np.inf
+	best = np.argmin(error, axis=1)
+	rows = np.arange(k)
+	found = error[rows, best] <= max_error
+	return np.column_stack((us[rows, best], vs[rows, best])).astype(np.float64), found
@@ -2,8 +2,23 @@ import cv2 as cv
 import numpy as np
 from matplotlib import pyplot as plt
 import time
-import orbslam2
+try:
+	import orbslam2
+except ImportError:
+	# only needed for the SLAM, the tracking and the offline tools work without it
+	orbslam2 = None
 from scipy.signal import butter, lfilter, filtfilt
+from frame_source import CameraSource, SessionRecorder, RecordingSource
+from rectification import load_or_build_maps, Rectifier, calibration_hash
+from stereo_matching import disparity_band, compute_disparity, sgbm_parameters, create_matcher, create_stereo_matcher, StripDisparity, \
+	load_matcher_config, DisparityPrior
+from pipeline import Pipeline
+from reprojection import reproject_points
+from filters import OnlineLowpass
+from tracking import BallTracker
+from sample_store import SampleStore, FLAG_TRACKED, FLAG_SPARSE, SAMPLE_DTYPE
+from binary_log import BinaryLog, TextLog, write_log, write_pose_text, poses_to_array
+from instrumentation import Instruments
 
 
 class Stereo:
@@ -21,6 +36,23 @@ class Stereo:
 		self._speckleWindowSize=5
 		self._speckleRange=2
 		self._preFilterCap=55
+		self.matcher_backend = 'sgbm_3way'   # matcher of the disparity, a name of stereo_matching.MATCHERS
+		self.strips = 1              # > 1 splits the disparity in horizontal strips computed in parallel
+		self.strip_overlap = None    # rows shared by two strips, by default 8*blockSize (at least 64)
+		self.strip_processes = False # use processes instead of threads for the strips
+		self.temporal_margin = 8     # disparities searched around the predicted one in the temporal mode
+		self.disparity_prior = []
+		self.temporal_matcher = []
+		self.use_tracker = False     # Kalman tracker that predicts the search window of the ball and rejects outliers
+		self.tracker = []
+		self.window = None           # search window of the ball in the current frame, None for the full image
+		self.detect_level = 0        # pyramid level of the search of the ball (1: 1/2, 2: 1/4), 0 for full resolution
+		self.instruments = Instruments(False)   # timers of the stages, instruments.enabled = True to measure
+		self.timings_file = 'timings'           # report of the timers (.json and .csv) at the end of a run
+		self.frame_time = 0.
+		self.path = path
+		self.calibration = ''        # hash of the calibration, written in the header of the logs
+		self.binary_logs = False     # Data.log, trajectory.log, keyframe.log (binary_log) instead of the text files
 		data = np.load(path)
 		self.K_l = data['K1']
 		self.K_r = data['K2']
@@ -34,21 +66,32 @@ class Stereo:
 		self.h, self.w = 480, 640
 		self.map1l, self.map2l = [], []
 		self.map1r, self.map2r = [], []
+		self.rectifier = []
 		self.left_matcher = []
 		self.slam = []
-		self.out = []
+		self.out = SampleStore()
 		self.f = []
+		self.source = []
+		self.max_skew = None          # maximum time difference between the left and right frames, seconds, half a frame period (1/2fs) if None
+		self.max_row_diff = 2.        # maximum row difference of the ball in both images for the sparse mode
 
 		# Filter requirements.
 		self.order = 3
 		self.fs = 30.0  # sample rate, Hz
 		self.cutoff = 2.  # desired cutoff frequency of the filter, Hz
+		self.lag = 0      # samples of delay of the fixed lag smoother of the online filter, 0 for causal only
+		self.butter = None
+		self.lowpass = []
+		self.filtered = SampleStore()
 
 	def butter_lowpass(self):
-		nyq = 0.5 * self.fs
-		normal_cutoff = self.cutoff / nyq
-		b, a = butter(self.order, normal_cutoff, btype='low', analog=False)
-		return b, a
+		# the coefficients only change with the filter requirements
+		if self.butter is None or self.butter[0] != (self.order, self.fs, self.cutoff):
+			nyq = 0.5 * self.fs
+			normal_cutoff = self.cutoff / nyq
+			b, a = butter(self.order, normal_cutoff, btype='low', analog=False)
+			self.butter = ((self.order, self.fs, self.cutoff), b, a)
+		return self.butter[1], self.butter[2]
 
 	def butter_lowpass_filter(self, data):
 		b, a = self.butter_lowpass()
@@ -56,38 +99,57 @@ class Stereo:
 		y = filtfilt(b, a, data, padlen=50)
 		return y
 
+	def matcher_parameters(self):
+	# The configuration of the SGBM matcher as a dict
+		return sgbm_parameters(self.window_size, self._minDisparity, self.a, self._blockSize, self._disp12MaxDiff,
+							   self._uniquenessRatio, self._speckleWindowSize, self._speckleRange, self._preFilterCap)
+
+	def matcher_config(self):
+	# The matcher and its configuration, in the form of the files of tune_sgbm.py
+		return {'matcher': self.matcher_backend, 'window_size': self.window_size, 'minDisparity': self._minDisparity,
+				'a': self.a, 'blockSize': self._blockSize, 'disp12MaxDiff': self._disp12MaxDiff,
+				'uniquenessRatio': self._uniquenessRatio, 'speckleWindowSize': self._speckleWindowSize,
+				'speckleRange': self._speckleRange, 'preFilterCap': self._preFilterCap}
+
+	def load_matcher_parameters(self, path):
+	# Matcher and configuration chosen by tune_sgbm.py, to be called before Initialize_mapping_calibration
+		config = load_matcher_config(path)
+		self.matcher_backend = config['matcher']
+		self.window_size = config['window_size']
+		self._minDisparity = config['minDisparity']
+		self.a = config['a']
+		self._blockSize = config['blockSize']
+		self._disp12MaxDiff = config['disp12MaxDiff']
+		self._uniquenessRatio = config['uniquenessRatio']
+		self._speckleWindowSize = config['speckleWindowSize']
+		self._speckleRange = config['speckleRange']
+		self._preFilterCap = config['preFilterCap']
+
 	def Initialize_mapping_calibration(self, disparity_bool = True, slam_bool=False, file_capture = False, fisheye = True):
 	# Initialize the mapping and the disparity matcher, to be called once and outside the loop
 		
 		#The mapping for the correction, careful always give the left image to the left parameters
-		# and the right to the right parameters
-		if fisheye:
-			self.map1l, self.map2l = cv.fisheye.initUndistortRectifyMap(self.K_l, self.D_l, self.R_l, self.P_l, (self.w,self.h), cv.CV_32FC1)
-			self.map1r, self.map2r = cv.fisheye.initUndistortRectifyMap(self.K_r, self.D_r, self.R_r, self.P_r, (self.w,self.h), cv.CV_32FC1)
-		else:
-			self.map1l, self.map2l = cv.initUndistortRectifyMap(self.K_l, self.D_l, self.R_l, self.P_l,
-																		(self.w, self.h), cv.CV_32FC1)
+		# and the right to the right parameters.
+		# The maps are in the fixed point form (CV_16SC2 + CV_16UC1) and cached on disk by calibration
+		self.map1l, self.map2l, self.map1r, self.map2r = load_or_build_maps(self, self.path, fisheye)
+		self.calibration = calibration_hash(self.path, (self.w, self.h), fisheye)
+		self.rectifier = Rectifier(self.map1l, self.map2l, self.map1r, self.map2r, instruments = self.instruments)
 
-			self.map1r, self.map2r = cv.initUndistortRectifyMap(self.K_r, self.D_r, self.R_r, self.P_r,
-																		(self.w, self.h), cv.CV_32FC1)
+		# Filter of the 3d coordinates while they are collected
+		self.lowpass = OnlineLowpass(self.order, self.cutoff, self.fs, 3, self.lag)
+		self.tracker = BallTracker(self.w, self.h) if self.use_tracker else []
 
 		if disparity_bool:
 			# The accuracy and the range of the disparity depends on these parameters
-			self.left_matcher = cv.StereoSGBM_create(
-				minDisparity=-self._minDisparity,
-				numDisparities=16*self.a,             # max_disp has to be dividable by 16 f. E. HH 192, 256
-				blockSize=self._blockSize,
-				P1=8 * 3 * self.window_size ** 2,    # wsize default 3; 5; 7 for SGBM reduced size image; 15 for SGBM full size image (1300px and above); 5 Works nicely
-				P2=32 * 3 * self.window_size ** 2,
-				disp12MaxDiff=self._disp12MaxDiff,
-				uniquenessRatio=self._uniquenessRatio,
-				speckleWindowSize=self._speckleWindowSize,
-				speckleRange=self._speckleRange,
-				preFilterCap=self._preFilterCap,
-				mode=cv.STEREO_SGBM_MODE_SGBM_3WAY)
-				
-			#Though this seems unecessary, it lowers the computation of the disparity map
-			wls_filter = cv.ximgproc.createDisparityWLSFilter(matcher_left=self.left_matcher)
+			if self.strips > 1:
+				self.left_matcher = StripDisparity(self.matcher_parameters(), self.strips, self.strip_overlap,
+												   processes = self.strip_processes, matcher = self.matcher_backend)
+			else:
+				self.left_matcher = create_stereo_matcher(self.matcher_backend, self.matcher_parameters())
+
+			# The temporal mode changes the range of its own matcher every frame
+			self.temporal_matcher = create_matcher(self.matcher_parameters())
+			self.disparity_prior = DisparityPrior(-self._minDisparity, 16*self.a, self.temporal_margin)
 		
 		if slam_bool:
 			vocab_path="Parameters/ORBvoc.txt"
@@ -97,13 +159,28 @@ class Stereo:
 			self.slam.initialize()
 		
 		if file_capture:
-			self.f = open("Data.txt", "w+")
+			if self.binary_logs:
+				# binary log of the samples, written by a background thread (log_to_text gives the text back)
+				self.f = BinaryLog("Data.log", SAMPLE_DTYPE, self.calibration, 'mm')
+			else:
+				self.f = TextLog("Data.txt")
 		
-	def detect_ball(self, imageleft, show = False):
+	def ball_mask(self, image):
+	# 255 where the colour is the one of the ball
+		hsv = cv.cvtColor(image, cv.COLOR_BGR2HSV)
+		return cv.inRange(hsv, (0, 100, 20), (20, 255, 255))
+
+	def detect_ball(self, imageleft, show = False, subpixel = False, offset = (0, 0), level = None):
 	# Part of the code to track the ball
+	# with subpixel the centre is the centroid of the contour as floats instead of the integer
+	# centre of the enclosing circle. offset is the position of imageleft if it is only a part of the image.
+	# level is the pyramid level of the search (self.detect_level by default), see detect_ball_coarse
+		if level is None:
+			level = self.detect_level
+		if level > 0:
+			return self.detect_ball_coarse(imageleft, show, subpixel, offset, level)
 	
-		hsv = cv.cvtColor(imageleft, cv.COLOR_BGR2HSV)
-		mask = cv.inRange(hsv, (0, 100, 20), (20, 255, 255))
+		mask = self.ball_mask(imageleft)
 		mask = cv.erode(mask,  None, iterations=1)
 		mask = cv.dilate(mask, None, iterations=2)
 		cnts = cv.findContours(mask.copy(), cv.RETR_EXTERNAL,
@@ -134,80 +211,225 @@ class Stereo:
 
 				xc = int(x)
 				yc = int(y)
+				if subpixel and M["m00"] > 0:
+					xc = M["m10"] / M["m00"]
+					yc = M["m01"] / M["m00"]
+				xc += offset[0]
+				yc += offset[1]
 		
 		if show:
 			cv.imshow('Image',imageleft)
 				
 		return xc, yc, int(radius)
+
+	def detect_ball_coarse(self, imageleft, show = False, subpixel = False, offset = (0, 0), level = 1):
+	# The ball is searched in the image reduced 2^level times, then measured at full resolution in
+	# a window around the candidate only. The segmentation, morphology and contours of the search
+	# cost 4^level times less, the result is the same (xc, yc, radius) as detect_ball
+		scale = 2 ** level
+		h, w = imageleft.shape[:2]
+		small = cv.resize(imageleft, (max(1, w // scale), max(1, h // scale)), interpolation = cv.INTER_NEAREST)
+		# no erosion at this scale, it would remove the small balls
+		mask = cv.dilate(self.ball_mask(small), None, iterations=1)
+		cnts = cv.findContours(mask, cv.RETR_EXTERNAL, cv.CHAIN_APPROX_SIMPLE)[-2]
+		xc, yc, radius = 0, 0, 0
+		if len(cnts) > 0:
+			c = max(cnts, key= cv.contourArea)
+			((x, y), r) = cv.minEnclosingCircle(c)
+			# the ball needs a radius > 10 at full resolution, up to a pixel of the small image
+			if (r + 1) * scale > 10:
+				margin = 2 * scale + 4
+				x0, y0 = max(0, int((x - r) * scale) - margin), max(0, int((y - r) * scale) - margin)
+				x1, y1 = min(w, int((x + r + 1) * scale) + margin), min(h, int((y + r + 1) * scale) + margin)
+				xc, yc, radius = self.detect_ball(imageleft[y0:y1, x0:x1], False, subpixel,
+												  (offset[0] + x0, offset[1] + y0), 0)
+		if show:
+			if radius > 0:
+				cv.circle(imageleft, (int(xc - offset[0]), int(yc - offset[1])), radius, (0, 255, 255), 1)
+			cv.imshow('Image',imageleft)
+		return xc, yc, radius
 	
-	def transform_disp_3d(self, xc, yc, disparity, start):
+	def transform_disp_3d(self, xc, yc, disparity, start, t = None):
 	# Here is the code that transforms the disparity and 2d coordinates to 3d coordinates
 	# we can alwazs use cv.reprojectImageTo3D(displ, Q) but we are only interested in 
-	# one point
-		R = np.array([[xc],
-						[yc],
-						[disparity],
-						[1]])
-		point_3d = (self.Q).dot(R)
-		image_3d = point_3d[0:3]/point_3d[3]
-		sxyz = []
-		
-		# This line is only here to reduce the big outliers and can be omitted
-		if(image_3d[2] < 2000 and image_3d[2] > 100):
-			t = time.time()
-			seconds = t - start
-			sxyz = [seconds, image_3d[0,0],image_3d[1,0],image_3d[2,0]]
-		
+	# one point. t is the time of the frame, by default the current time
+		sxyz = self.transform_points_3d([(xc, yc, disparity)], start, t)
+		if len(sxyz) == 0:
+			return []
+		return [sxyz[0, 0], sxyz[0, 1], sxyz[0, 2], sxyz[0, 3]]
+
+	def transform_points_3d(self, points, start, t = None):
+	# Same for N points (x, y, disparity) at once, returns the N x 4 (seconds, x, y, z) array
+	# of the points that pass the depth gate
+		with self.instruments.timer('reprojection'):
+			image_3d, mask = reproject_points(points, self.Q)
+			if t is None:
+				t = time.time()
+			# the gate is only here to reduce the big outliers and can be omitted
+			sxyz = np.empty((np.count_nonzero(mask), 4))
+			sxyz[:, 0] = t - start
+			sxyz[:, 1:] = image_3d[mask]
 		return sxyz
 	
-	def collect_single_frame_data(self, left_frame, right_frame, start, show = False, file_capture = False):
+	def ball_roi(self, xc, yc, radius, min_disparity = None, num_disparities = None):
+	# The band of the images needed by the matcher to get the disparity of the ball
+		if min_disparity is None:
+			min_disparity, num_disparities = -self._minDisparity, 16*self.a
+		return disparity_band(xc, yc, radius, self._blockSize, min_disparity, num_disparities, self.w, self.h)
+
+	def locate_ball(self, imageleft, show = False, subpixel = False):
+	# Detect the ball in the left image, or only in the search window predicted by the tracker
+	# (imageleft is then only that window). The tracker drops the detections too far from its prediction
+		offset = (0, 0) if self.window is None else self.window[:2]
+		with self.instruments.timer('detect_ball'):
+			xc, yc, radius = self.detect_ball(imageleft, show, subpixel, offset)
+		if self.tracker and not self.tracker.update_image(xc, yc, radius, self.frame_time):
+			return 0, 0, 0
+		return xc, yc, radius
+
+	def temporal_disparity(self, imgL, imgR, imageleft, show = False):
+	# Like the roi mode, but the disparity range searched is a window around the disparity
+	# predicted from the previous frames
+		xc, yc, radius = self.locate_ball(imageleft, show)
+		if not (xc > 0 and yc > 0):
+			self.disparity_prior.update(None)
+			return None
+
+		low, num = self.disparity_prior.window()
+		self.temporal_matcher.setMinDisparity(low)
+		self.temporal_matcher.setNumDisparities(num)
+		roi = self.ball_roi(xc, yc, radius, low, num)
+		with self.instruments.timer('matcher'):
+			displ = compute_disparity(self.temporal_matcher, imgL, imgR, roi)
+		disparity = displ[yc - roi[1], xc - roi[0]]
+		self.disparity_prior.update(disparity)
+		if disparity < low:
+			return None
+		return xc, yc, disparity, radius
+
+	def sparse_disparity(self, imageleft, imageright, show = False):
+	# Detect the ball in both rectified images and get the disparity directly from the two centroids.
+	# The epipolar lines are horizontal after the rectification, so both centroids have to be
+	# on the same row and the disparity is just the difference of the columns
+		xl, yl, radius = self.locate_ball(imageleft, show, subpixel = True)
+		with self.instruments.timer('detect_ball_right'):
+			xr, yr, _ = self.detect_ball(imageright, False, subpixel = True)
+
+		if xl > 0 and yl > 0 and xr > 0 and yr > 0 and abs(yl - yr) <= self.max_row_diff:
+			return xl, yl, xl - xr, radius
+		return None
+
+	def rectify_frames(self, left_frame, right_frame, disparity_mode = 'full'):
+	# The sparse mode only needs both colour images, the others the gray images and the left colour one.
+	# With a search window only that part of the left colour image is rectified
+		if disparity_mode == 'sparse':
+			return self.rectifier.rectify(left_frame, right_frame, color_right = True, roi = self.window, gray = False)
+		return self.rectifier.rectify(left_frame, right_frame, roi = self.window)
+
+	def measure_ball(self, imgL, imgR, imageleft, imageright, show = False, disparity_mode = 'full'):
+	# Position of the ball in the left image, its disparity and its radius, None if there is no measure
+		if disparity_mode == 'sparse':
+			return self.sparse_disparity(imageleft, imageright, show)
+
+		if disparity_mode == 'temporal':
+			return self.temporal_disparity(imgL, imgR, imageleft, show)
+
+		if disparity_mode == 'roi':
+			# Get the coordinates of the ball first
+			xc, yc, radius = self.locate_ball(imageleft, show)
+			roi = None
+			x0, y0 = 0, 0
+			if xc > 0 and yc > 0:
+				roi = self.ball_roi(xc, yc, radius)
+				x0, y0 = roi[0], roi[1]
+			with self.instruments.timer('matcher'):
+				displ = compute_disparity(self.left_matcher, imgL, imgR, roi)
+			disparity = displ[yc - y0, xc - x0]
+		else:
+			# Calculate the disparity map
+			with self.instruments.timer('matcher'):
+				displ = compute_disparity(self.left_matcher, imgL, imgR)
+			#cv.imshow('disparity',cv.normalize(displ, None, alpha = 0, beta = 1, norm_type=cv.NORM_MINMAX, dtype=cv.CV_32F))
+			# Get the coordinates of the ball
+			xc, yc, radius = self.locate_ball(imageleft, show)
+			disparity = displ[yc, xc]
+		return xc, yc, disparity, radius
+
+	def collect_single_frame_data(self, left_frame, right_frame, start, show = False, file_capture = False,
+								disparity_mode = 'full', t = None):
 	# This function gets the 3d coordinates of the basketball for one frame, to be called inside a loop
+	# disparity_mode 'full' computes the disparity on the full images, 'roi' detects the ball first
+	# and computes the disparity only on a band around it (full images if there is no ball),
+	# 'temporal' is 'roi' with the disparity range narrowed around the one of the last frames,
+	# 'sparse' does not compute any disparity map and triangulates the ball from both images
+	# t is the timestamp of the frames (time.time() clock), now if not given
 		
-		# Start by rectifying the images
-		imgL = cv.remap(left_frame, self.map1l, self.map2l, interpolation=cv.INTER_LINEAR)
-		imgR = cv.remap(right_frame, self.map1r, self.map2r, interpolation=cv.INTER_LINEAR)
-		imageleft=imgL.copy()
-		imgL=cv.cvtColor(imgL, cv.COLOR_BGR2GRAY)
-		imgR=cv.cvtColor(imgR, cv.COLOR_BGR2GRAY)
+		# The tracker gives the part of the image where the ball should be
+		self.frame_time = time.time() if t is None else t
+		if self.tracker:
+			self.window = self.tracker.predict(self.frame_time)
 		
-		# Calculate the disparity map
-		displ = self.left_matcher.compute(imgL, imgR).astype(np.float32)/16
-		displ = np.int16(displ)
-		#cv.imshow('disparity',cv.normalize(displ, None, alpha = 0, beta = 1, norm_type=cv.NORM_MINMAX, dtype=cv.CV_32F))
-		# Get the coordinates of the ball
-		xc, yc, _ = self.detect_ball(imageleft, show)
+		# Start by rectifying the images, the gray images are used for the disparity
+		# and the left colour image for the detection of the ball
+		imgL, imgR, imageleft, imageright = self.rectify_frames(left_frame, right_frame, disparity_mode)
 		
-		# Transform these 2d coordinates into 3d
-		sxyz = self.transform_disp_3d( xc, yc, displ[yc, xc], start)
+		measure = self.measure_ball(imgL, imgR, imageleft, imageright, show, disparity_mode)
 		
-		# if we want to save the values in a file
-		if file_capture:
-			self.f.write("{}, {}, {}, {} \n".format(sxyz[0], sxyz[1], sxyz[2], sxyz[3]))
-			
-		#print(("{}, {}, {}, {} \n".format(sxyz[0], sxyz[1], sxyz[2], sxyz[3])))
-		if sxyz:
-			(self.out).append([sxyz[0], sxyz[1], sxyz[2], sxyz[3]])
+		# Transform these 2d coordinates into 3d
+		sxyz = []
+		disparity, radius = 0, 0
+		if measure is not None:
+			xc, yc, disparity, radius = measure
+			sxyz = self.transform_disp_3d( xc, yc, disparity, start, self.frame_time)
+			# the tracker rejects the 3d outliers
+			if sxyz and self.tracker and not self.tracker.update_world(sxyz[1:4], self.frame_time):
+				sxyz = []
+		flags = (FLAG_TRACKED if self.tracker else 0) | (FLAG_SPARSE if disparity_mode == 'sparse' else 0)
+		self.record_sample(sxyz, file_capture, disparity, flags, radius)
+		self.instruments.count('frames')
+		if not sxyz:
+			self.instruments.count('frames_without_ball')
+
+	def record_sample(self, sxyz, file_capture = False, disparity = 0, flags = 0, radius = 0):
+	# Store the sample of a frame with the disparity and the radius of the detected ball
+		with self.instruments.timer('logging'):
+			# if we want to save the values in a file
+			if file_capture and sxyz:
+				self.f.write(sxyz[0], sxyz[1], sxyz[2], sxyz[3], disparity, radius, flags)
+				
+			#print(("{}, {}, {}, {} \n".format(sxyz[0], sxyz[1], sxyz[2], sxyz[3])))
+			if sxyz:
+				self.out.append(sxyz[0], sxyz[1], sxyz[2], sxyz[3], disparity, radius, flags)
+				# with lag > 0 the smoothed sample is the one of lag frames ago, with its time
+				smoothed = self.lowpass.step(sxyz[1:4], (sxyz[0], disparity, radius, flags))
+				if smoothed is not None:
+					(t, d, r, fl), (x, y, z) = smoothed
+					self.filtered.append(t, x, y, z, d, r, fl)
 		
 	def plot_charts(self):
 	# Funtion to plot the 3d coordinates
-		self.out = np.array(self.out)
+		out = self.out.as_array()
+		filtered = self.filtered.as_array()
 		plt.figure('time')
-		plt.plot(self.out[:,0], label='3D')
+		plt.plot(out[:,0], label='3D')
 		plt.legend(loc='upper left')
 		plt.figure('x cm')
-		y1 = self.butter_lowpass_filter(self.out[:, 1])
-		plt.plot(self.out[:,1], label='3D')
+		y1 = self.butter_lowpass_filter(out[:, 1])
+		plt.plot(out[:,1], label='3D')
 		plt.plot(y1, label='3D filtered')
+		plt.plot(filtered[:,1], label='3D filtered online')
 		plt.legend(loc='upper left')
 		plt.figure('y cm')
-		y2 = self.butter_lowpass_filter(self.out[:, 2])
-		plt.plot(self.out[:,2], label='3D')
+		y2 = self.butter_lowpass_filter(out[:, 2])
+		plt.plot(out[:,2], label='3D')
 		plt.plot(y2, label='3D filtered')
+		plt.plot(filtered[:,2], label='3D filtered online')
 		plt.legend(loc='upper left')
 		plt.figure('z cm')
-		y3 = self.butter_lowpass_filter(self.out[:,3])
-		plt.plot(self.out[:,3], label='3D')
+		y3 = self.butter_lowpass_filter(out[:,3])
+		plt.plot(out[:,3], label='3D')
 		plt.plot(y3, label='3D filtered')
+		plt.plot(filtered[:,3], label='3D filtered online')
 		plt.legend(loc='upper left')
 		plt.show()
 	
@@ -221,26 +443,125 @@ class Stereo:
 		capture_right.release()
 
 		
-	def collect_frames_data(self, capture_left, capture_right, num_frames, show = False, file_capture = False, fisheye = True):
+	def read_frames(self):
+	# Read one pair of frames from the source given to start_capture
+		with self.instruments.timer('capture'):
+			return self.source.read()
+
+	def report_timings(self, path = None):
+	# Print the timers of the stages and write them to path.json and path.csv (self.timings_file by default)
+		if not self.instruments.enabled:
+			return
+		if path is None:
+			path = self.timings_file
+		self.instruments.print_report()
+		self.instruments.export_json(path + '.json')
+		self.instruments.export_csv(path + '.csv')
+
+	def start_capture(self, capture_left, capture_right, threaded_capture = False, source = None):
+	# The frames come from source (a recorded session of frame_source for instance) or from the cameras.
+	# With threaded_capture each camera gets its own grabber thread and the frames
+	# are paired by timestamp, so the reads are not on the processing thread anymore
+		if source is None:
+			source = CameraSource(capture_left, capture_right, threaded_capture, self.max_skew, self.fs)
+		self.source = source.start()
+
+	def stop_capture(self):
+		if self.source:
+			self.source.stop()
+			stats = self.source.stats() if hasattr(self.source, 'stats') else None
+			if stats:
+				print ("Pairs : {0}, dropped pairs : {1}".format(stats['pairs'], stats['dropped_pairs']))
+				print ("Mean skew : {0} ms, max skew : {1} ms".format(1000*stats['mean_skew'], 1000*stats['max_skew']))
+			self.source = []
+
+	def record(self, capture_left, capture_right, path, num_frames, threaded_capture = False, fisheye = True):
+	# Record the raw frames of the cameras and their timestamps in a session folder, to replay them
+	# later with frame_source.SessionSource as the source of collect_frames_data or SLAM.
+	# fisheye is the lens model of the calibration, like in collect_frames_data
+		self.calibration = calibration_hash(self.path, (self.w, self.h), fisheye)
+		recorder = SessionRecorder(path, ('left', 'right'), metadata = {'calibration': self.calibration, 'fisheye': fisheye})
+		self.start_capture(capture_left, capture_right, threaded_capture,
+						   RecordingSource(CameraSource(capture_left, capture_right, threaded_capture, self.max_skew, self.fs), recorder))
+		for frames in range(num_frames):
+			ret, _, _ = self.read_frames()
+			if not ret:
+				break
+		self.stop_capture()
+
+	def run_pipeline(self, capture_left, capture_right, num_frames, start, file_capture = False,
+					disparity_mode = 'full', policy = 'drop_oldest', queue_size = 2):
+	# Same loop as collect_frames_data but capture, rectification, matching and reprojection run on
+	# their own threads connected by bounded queues. 'drop_oldest' keeps the newest frames for real time,
+	# 'block' processes every frame for offline runs. The windows are not shown and the tracker is
+	# not used in this mode, its prediction needs the result of the previous frame
+		self.tracker, self.window = [], None
+		# every frame in flight needs its own rectification buffers
+		self.rectifier = Rectifier(self.map1l, self.map2l, self.map1r, self.map2r, buffers = 4*(queue_size + 1) + 1,
+								   instruments = self.instruments)
+
+		def capture():
+			ret, frame_left, frame_right = self.read_frames()
+			if not ret:
+				return None
+			return {'t': self.source.timestamp, 'left': frame_left, 'right': frame_right}
+
+		def rectify(item):
+			item['images'] = self.rectify_frames(item['left'], item['right'], disparity_mode)
+			return item
+
+		def match(item):
+			imgL, imgR, imageleft, imageright = item['images']
+			item['measure'] = self.measure_ball(imgL, imgR, imageleft, imageright, False, disparity_mode)
+			return item
+
+		def reproject(item):
+			sxyz = []
+			disparity, radius = 0, 0
+			if item['measure'] is not None:
+				xc, yc, disparity, radius = item['measure']
+				sxyz = self.transform_disp_3d(xc, yc, disparity, start, item['t'])
+			self.record_sample(sxyz, file_capture, disparity if sxyz else 0,
+							   FLAG_SPARSE if disparity_mode == 'sparse' else 0, radius if sxyz else 0)
+			return item
+
+		pipeline = Pipeline(queue_size, policy)
+		pipeline.add_stage('rectify', rectify).add_stage('match', match).add_stage('reproject', reproject)
+		processed = pipeline.run(capture, num_items = num_frames)
+		pipeline.print_metrics()
+		return processed
+
+	def collect_frames_data(self, capture_left, capture_right, num_frames, show = False, file_capture = False, fisheye = True,
+							threaded_capture = False, disparity_mode = 'full', pipelined = False, policy = 'drop_oldest',
+							source = None):
 	# This part of the code give you the matrix of 3d coordinates of the ball for X frames
+	# source replaces the cameras, e.g. frame_source.SessionSource for a recorded session
 	
-		# Start by initializing the mapping and disparity
-		self.Initialize_mapping_calibration(disparity_bool = True, slam_bool=False, fisheye = fisheye)
+		# Start by initializing the mapping and disparity, the sparse mode does not need the matcher
+		self.Initialize_mapping_calibration(disparity_bool = disparity_mode != 'sparse', slam_bool=False, fisheye = fisheye)
+		self.start_capture(capture_left, capture_right, threaded_capture, source)
 		
 		# Start a counter to measure fps
 		start = time.time()
 		
-		
-		for frames in range(num_frames):
-			ret, frame_left = capture_left.read()
-			ret1, frame_right = capture_right.read()
-			self.collect_single_frame_data(frame_left, frame_right, start, show, file_capture)
-			if cv.waitKey(1) & 0xFF == ord('q'):
-				break
+		if pipelined:
+			# in real time some frames can be dropped, the fps is the one of the processed frames
+			num_frames = self.run_pipeline(capture_left, capture_right, num_frames, start, file_capture,
+										   disparity_mode, policy)
+		else:
+			for frames in range(num_frames):
+				ret, frame_left, frame_right = self.read_frames()
+				if not ret:
+					break
+				self.collect_single_frame_data(frame_left, frame_right, start, show, file_capture, disparity_mode,
+											   self.source.timestamp)
+				if cv.waitKey(1) & 0xFF == ord('q'):
+					break
 
 		
 		# End time
 		end = time.time()
+		self.stop_capture()
 
 		# Time elapsed
 		seconds = end - start
@@ -249,65 +570,45 @@ class Stereo:
 		# Calculate frames per second
 		fps  = num_frames / seconds;
 		print ("Estimated frames per second : {0}".format(fps))
+		self.report_timings()
 		
-		return self.out
+		return self.out.as_array()
 		
+	def save_poses(self, filename, points):
+	# TIME t r00 ... t2 text, or with binary_logs the binary log of the poses (log_to_text gives the text back)
+		if self.binary_logs:
+			write_log(filename, poses_to_array(points), self.calibration, 'm')
+		else:
+			write_pose_text(filename, points)
+
 	def save_trajectory(self, filename):
-		with open(filename, 'w') as traj_file:
-			traj_file.writelines(' TIME {time} {r00} {r01} {r02} {t0} {r10} {r11} {r12} {t1} {r20} {r21} {r22} {t2}\n'.format(
-				time=repr(t),
-				r00=repr(r00),
-				r01=repr(r01),
-				r02=repr(r02),
-				t0=repr(t0),
-				r10=repr(r10),
-				r11=repr(r11),
-				r12=repr(r12),
-				t1=repr(t1),
-				r20=repr(r20),
-				r21=repr(r21),
-				r22=repr(r22),
-				t2=repr(t2)
-			) for t, r00, r01, r02, t0, r10, r11, r12, t1, r20, r21, r22, t2 in self.slam.get_trajectory_points())
+		self.save_poses(filename, self.slam.get_trajectory_points())
+
 	def save_keyframe(self, filename):
-		with open(filename, 'w') as traj_file:
-			traj_file.writelines(' TIME {time} {r00} {r01} {r02} {t0} {r10} {r11} {r12} {t1} {r20} {r21} {r22} {t2}\n'.format(
-				time=repr(t),
-				r00=repr(r00),
-				r01=repr(r01),
-				r02=repr(r02),
-				t0=repr(t0),
-				r10=repr(r10),
-				r11=repr(r11),
-				r12=repr(r12),
-				t1=repr(t1),
-				r20=repr(r20),
-				r21=repr(r21),
-				r22=repr(r22),
-				t2=repr(t2)
-			) for t, r00, r01, r02, t0, r10, r11, r12, t1, r20, r21, r22, t2 in self.slam.get_keyframe_points())
+		self.save_poses(filename, self.slam.get_keyframe_points())
 
 	def SLAM_single_cycle(self, left_frame, right_frame, start):
 		t = time.time()
 		seconds = t - start
 		tframe = seconds
 		
-		# Start by rectifying the images
-		imgL = cv.remap(left_frame, self.map1l, self.map2l, interpolation=cv.INTER_LINEAR)
-		imgR = cv.remap(right_frame, self.map1r, self.map2r, interpolation=cv.INTER_LINEAR)
-		xc, yc, radius = self.detect_ball(imgL, False)
+		# Start by rectifying the images, ORB-SLAM works on the gray images
+		imgL, imgR, imageleft, _ = self.rectifier.rectify(left_frame, right_frame)
+		xc, yc, radius = self.detect_ball(imageleft, False)
 
 		t1 = time.time()
 		self.slam.process_image_stereo(imgL, imgR, tframe)
 		t2 = time.time()
 
 		ttrack = t2 - t1
+		self.instruments.record('slam', ttrack)
 		return ttrack, xc, yc, radius
 
-	def SLAM(self, capture_left, capture_right, num_frames):
+	def SLAM(self, capture_left, capture_right, num_frames, threaded_capture = False, source = None):
 
 		# Start by initializing the mapping and disparity
 		self.Initialize_mapping_calibration(disparity_bool = True, slam_bool=True)
+		self.start_capture(capture_left, capture_right, threaded_capture, source)
 
 		# Start a counter to measure fps
 		start = time.time()
@@ -319,10 +620,11 @@ class Stereo:
 		print('Start processing sequence ...')
 		ball = []
 		for idx in range(num_frames):
-			ret, frame_left = capture_left.read()
-			ret1, frame_right = capture_right.read()
+			ret, frame_left, frame_right = self.read_frames()
+			if not ret:
+				break
 			times_track[idx], xc, yc, radius = self.SLAM_single_cycle(frame_left, frame_right, start)
-			self.collect_single_frame_data(frame_left, frame_right, start, False, False)
+			self.collect_single_frame_data(frame_left, frame_right, start, False, False, t = self.source.timestamp)
 
 			traj = self.slam.get_keyframe_XY()
 			if len(traj) > 0:
@@ -338,6 +640,7 @@ class Stereo:
 
 		# End time
 		end = time.time()
+		self.stop_capture()
 
 		# Time elapsed
 		seconds = end - start
@@ -347,13 +650,14 @@ class Stereo:
 		fps = num_frames / seconds;
 		print("Estimated frames per second : {0}".format(fps))
 
-		self.save_trajectory('trajectory.txt')
-		self.save_keyframe('keyframe.txt')
+		extension = '.log' if self.binary_logs else '.txt'
+		self.save_trajectory('trajectory' + extension)
+		self.save_keyframe('keyframe' + extension)
 
 		trajec = self.slam.get_trajectory_points()
 		trajec = np.array(trajec)
 
-		self.out = np.array(self.out)
+		out = self.out.as_array()
 
 		ball = np.array(ball)
 		print(ball)
@@ -362,7 +666,7 @@ class Stereo:
 		plt.plot(ball[:,0], ball[:,1],'r', label='3D global', marker='*')
 		plt.plot(trajec[:,4], trajec[:,12],'b', label='Stereo system')
 		plt.plot(trajec[:,4] + 10, trajec[:,12],'k', label='Stereo system second')
-		plt.plot(self.out[:,1]/1000 + 10, self.out[:,3]/1000,'g', label='3D relative', marker='*')
+		plt.plot(out[:,1]/1000 + 10, out[:,3]/1000,'g', label='3D relative', marker='*')
 		plt.legend(loc='upper left')
 		plt.show()
 		times_track = sorted(times_track)
@@ -370,6 +674,7 @@ class Stereo:
 		print('-----')
 		print('median tracking time: {0}'.format(times_track[num_frames // 2]))
 		print('mean tracking time: {0}'.format(total_time / num_frames))
+		self.report_timings()
 
 		return 0
 	
@@ -385,7 +690,7 @@ if __name__ == '__main__':
 	cv.waitKey(1000)
 	disparity_map = Stereo('Parameters/fish_final_calib.npz')
 	#out = disparity_map.collect_frames_data(capture_left, capture_right, num_frames, show= True, fisheye = True)
-	disparity_map.SLAM(capture_left, capture_right, num_frames)
+	disparity_map.SLAM(capture_left, capture_right, num_frames, threaded_capture = True)
 	disparity_map.destroy_feed(capture_left, capture_right)
 	disparity_map.plot_charts()
 	
@@ -0,0 +1,67 @@
+import numpy as np
+from collections import deque
+from scipy.signal import butter, sosfilt, sosfilt_zi
+
+
+class OnlineLowpass:
+	# Butterworth low pass filter applied sample by sample, the second order sections are
+	# computed once and every axis keeps its state, so a sample costs the same whatever the
+	# length of the run. With lag > 0 smooth() also gives a fixed lag smoother: the last lag + 1
+	# outputs are filtered backward (like filtfilt) so the sample of lag frames ago has almost
+	# no phase delay, at the cost of lag frames of latency
+
+	def __init__(self, order = 3, cutoff = 2., fs = 30., axes = 3, lag = 0):
+		nyq = 0.5 * fs
+		self.sos = butter(order, cutoff / nyq, btype='low', analog=False, output='sos')
+		self.zi_unit = sosfilt_zi(self.sos)            # steady state for an input of 1
+		self.axes = axes
+		self.lag = lag
+		self.z = None
+		self.history = deque(maxlen=lag + 1)
+		self.tags = deque(maxlen=lag + 1)
+		self.last = None
+
+	def reset(self):
+		self.z = None
+		self.history.clear()
+		self.tags.clear()
+		self.last = None
+
+	def update(self, sample):
+		# filter one sample (one value per axis), returns the causal output
+		x = np.asarray(sample, np.float64).reshape(self.axes)
+		if self.z is None:
+			# start in the steady state of the first sample instead of zero
+			self.z = self.zi_unit[:, :, None] * x
+		z = self.z
+		# direct form II transposed, one section after the other
+		for s, (b0, b1, b2, a0, a1, a2) in enumerate(self.sos):
+			y = b0 * x + z[s, 0]
+			z[s, 0] = b1 * x - a1 * y + z[s, 1]
+			z[s, 1] = b2 * x - a2 * y
+			x = y
+		self.last = x
+		if self.lag > 0:
+			self.history.append(x)
+		return x
+
+	def smooth(self):
+		# zero phase estimate of the sample of lag frames ago, None until there are enough samples
+		if self.lag == 0:
+			return self.last
+		if len(self.history) <= self.lag:
+			return None
+		forward = np.array(self.history)
+		backward, _ = sosfilt(self.sos, forward[::-1], axis=0, zi=self.zi_unit[:, :, None] * forward[-1])
+		return backward[-1]
+
+	def step(self, sample, tag = None):
+		# update() then smooth(): (tag, value) of the output, where tag is the one given with the
+		# sample the value belongs to (its time for instance, lag frames ago with lag > 0), None
+		# until there are enough samples
+		self.update(sample)
+		self.tags.append(tag)
+		value = self.smooth()
+		if value is None:
+			return None
+		return self.tags[0], value
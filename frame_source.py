@@ -0,0 +1,236 @@
+import numpy as np
+import json
+import os
+import threading
+import time
+from queue import Queue
+from capture import StereoCapture
+
+# Sources of pairs of frames (left / right images, or colour / depth of the Realsense).
+# A source has start(), read() -> (ret, first, second) like cv.VideoCapture.read with both
+# images, the timestamp of the last pair (seconds, same clock as time.time()) and stop().
+# Any source can be recorded to a session folder and the session replayed with SessionSource
+
+
+class CameraSource:
+	# Two cv.VideoCapture, read one after the other or paired by timestamp by the grabber threads
+
+	def __init__(self, capture_left, capture_right, threaded = False, max_skew = None, fps = 30.):
+		self.capture_left = capture_left
+		self.capture_right = capture_right
+		self.threaded = threaded
+		self.max_skew = max_skew        # half the frame period if None
+		self.fps = fps
+		self.stereo_capture = None
+		self.timestamp = 0.
+		# the grabbers use the monotonic clock
+		self.clock_offset = 0.
+
+	def start(self):
+		if self.threaded:
+			self.clock_offset = time.time() - time.monotonic()
+			self.stereo_capture = StereoCapture(self.capture_left, self.capture_right, self.max_skew, fps = self.fps).start()
+		return self
+
+	def read(self):
+		if self.stereo_capture is not None:
+			ret, frame_left, frame_right = self.stereo_capture.read()
+			self.timestamp = self.stereo_capture.timestamp + self.clock_offset
+			return ret, frame_left, frame_right
+		self.timestamp = time.time()
+		ret, frame_left = self.capture_left.read()
+		ret1, frame_right = self.capture_right.read()
+		return ret and ret1, frame_left, frame_right
+
+	def stats(self):
+		return self.stereo_capture.stats() if self.stereo_capture is not None else None
+
+	def stop(self):
+		if self.stereo_capture is not None:
+			self.stereo_capture.stop()
+
+
+class RealsenseSource:
+	# Colour and depth images of a started rs.pipeline, aligned with align (rs.align) if given
+
+	def __init__(self, pipeline, align = None):
+		self.pipeline = pipeline
+		self.align = align
+		self.timestamp = 0.
+		self.frames = None          # the last frameset, for the code that needs the frames themselves
+
+	def start(self):
+		return self
+
+	def read(self):
+		frames = self.pipeline.wait_for_frames()
+		self.timestamp = time.time()
+		if self.align is not None:
+			frames = self.align.process(frames)
+		self.frames = frames
+		depth_frame = frames.get_depth_frame()
+		color_frame = frames.get_color_frame()
+		if not depth_frame or not color_frame:
+			return False, None, None
+		return True, np.asanyarray(color_frame.get_data()), np.asanyarray(depth_frame.get_data())
+
+	def stop(self):
+		pass
+
+
+class SessionRecorder:
+	# Writes the pairs and their timestamps to a session folder: every chunk of chunk_size frames
+	# is one .npy file per stream, memory mapped, so a frame costs a copy into the page cache.
+	# The chunks are flushed by a background thread and session.json (streams, chunks, number of
+	# frames, metadata like the intrinsics) is rewritten after every chunk, so a crash only loses
+	# the last chunk
+
+	def __init__(self, path, streams = ('left', 'right'), chunk_size = 256, metadata = None):
+		self.path = path
+		self.streams = streams
+		self.chunk_size = chunk_size
+		self.metadata = metadata or {}
+		self.count = 0
+		self.chunks = []             # names of the chunks, the index is rewritten by the flusher thread
+		self.arrays = None
+		self.timestamps = None
+		if not os.path.isdir(path):
+			os.makedirs(path)
+		self.pending = Queue()
+		self.thread = threading.Thread(target=self._flusher, name='SessionRecorder')
+		self.thread.daemon = True
+		self.thread.start()
+
+	def _flusher(self):
+		while True:
+			item = self.pending.get()
+			if item is None:
+				break
+			arrays, count = item
+			for array in arrays:
+				array.flush()
+			self._write_index(count)
+
+	def _write_index(self, count):
+		index = {'streams': list(self.streams), 'chunk_size': self.chunk_size, 'chunks': self.chunks,
+				 'count': count, 'metadata': self.metadata}
+		tmp = os.path.join(self.path, 'session.json.tmp')
+		with open(tmp, 'w') as index_file:
+			json.dump(index, index_file, indent=2)
+		os.replace(tmp, os.path.join(self.path, 'session.json'))
+
+	def _new_chunk(self, frames):
+		number = len(self.chunks)
+		name = 'chunk_{0:05d}'.format(number)
+		self.chunks.append(name)
+		self.arrays = [np.lib.format.open_memmap(os.path.join(self.path, '{0}_{1}.npy'.format(name, stream)),
+												 mode='w+', dtype=frame.dtype, shape=(self.chunk_size,) + frame.shape)
+					   for stream, frame in zip(self.streams, frames)]
+		self.timestamps = np.lib.format.open_memmap(os.path.join(self.path, '{0}_t.npy'.format(name)),
+													mode='w+', dtype=np.float64, shape=(self.chunk_size,))
+
+	def write(self, timestamp, *frames):
+		index = self.count % self.chunk_size
+		if index == 0:
+			self._new_chunk(frames)
+		for array, frame in zip(self.arrays, frames):
+			array[index] = frame
+		self.timestamps[index] = timestamp
+		self.count += 1
+		if index == self.chunk_size - 1:
+			self.pending.put((self.arrays + [self.timestamps], self.count))
+
+	def close(self):
+		if self.arrays is not None and self.count % self.chunk_size:
+			self.pending.put((self.arrays + [self.timestamps], self.count))
+		self.pending.put(None)
+		self.thread.join()
+		self._write_index(self.count)
+
+
+class RecordingSource:
+	# Passes the pairs of a source through and records them
+
+	def __init__(self, source, recorder):
+		self.source = source
+		self.recorder = recorder
+		self.timestamp = 0.
+
+	def start(self):
+		self.source.start()
+		return self
+
+	def read(self):
+		ret, first, second = self.source.read()
+		self.timestamp = self.source.timestamp
+		if ret:
+			self.recorder.write(self.timestamp, first, second)
+		return ret, first, second
+
+	def stop(self):
+		self.source.stop()
+		self.recorder.close()
+
+
+class SessionSource:
+	# Replay of a recorded session, the frames are read only views of the memory mapped chunks
+	# (no copy). With realtime the pairs come at the pace of the recording, otherwise as fast as
+	# they are read. The timestamps keep the intervals of the recording from the start of the replay
+
+	def __init__(self, path, realtime = False, loop = False):
+		with open(os.path.join(path, 'session.json')) as index_file:
+			index = json.load(index_file)
+		self.path = path
+		self.streams = index['streams']
+		self.chunk_size = index['chunk_size']
+		self.count = index['count']
+		self.metadata = index['metadata']
+		self.realtime = realtime
+		self.loop = loop
+		self.chunks = [[np.load(os.path.join(path, '{0}_{1}.npy'.format(name, stream)), mmap_mode='r')
+						for stream in self.streams] for name in index['chunks']]
+		self.times = [np.load(os.path.join(path, '{0}_t.npy'.format(name)), mmap_mode='r') for name in index['chunks']]
+		self.position = 0
+		self.timestamp = 0.
+		self.start_time = None
+		self.first_time = None
+		self.lap_offset = 0.
+		# a lap of the loop lasts the recording and one frame period, the mean one
+		if self.count > 1:
+			duration = float(self.times[-1][(self.count - 1) % self.chunk_size]) - float(self.times[0][0])
+			self.lap = duration * self.count / (self.count - 1)
+		else:
+			self.lap = 1 / 30.
+
+	def __len__(self):
+		return self.count
+
+	def start(self):
+		self.position = 0
+		self.lap_offset = 0.
+		self.start_time = time.time()
+		self.first_time = float(self.times[0][0]) if self.count else 0.
+		return self
+
+	def read(self):
+		if self.start_time is None:
+			self.start()
+		if self.position >= self.count:
+			if not self.loop or self.count == 0:
+				return False, None, None
+			# the next lap goes on one frame period after the last timestamp
+			self.lap_offset += self.lap
+			self.position = 0
+		chunk, index = divmod(self.position, self.chunk_size)
+		self.position += 1
+		offset = float(self.times[chunk][index]) - self.first_time
+		self.timestamp = self.start_time + self.lap_offset + offset
+		if self.realtime:
+			delay = self.timestamp - time.time()
+			if delay > 0:
+				time.sleep(delay)
+		first, second = self.chunks[chunk][0][index], self.chunks[chunk][1][index]
+		return True, first, second
+
+	def stop(self):
+		pass
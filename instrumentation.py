@@ -0,0 +1,162 @@
+import csv
+import json
+import math
+import time
+
+# Timers, latency histograms and counters of the stages of the tracking loop. Disabled, a timer is
+# a shared object that does nothing, so the instrumented code costs two method calls per stage
+
+SUB_BUCKETS = 8          # buckets per power of two, the percentiles are within ~9%
+
+
+class Histogram:
+	# Log bucketed histogram of durations, fixed memory whatever the number of samples
+
+	def __init__(self):
+		self.buckets = {}
+		self.count = 0
+		self.total = 0.
+		self.max = 0.
+
+	def record(self, seconds):
+		self.count += 1
+		self.total += seconds
+		if seconds > self.max:
+			self.max = seconds
+		if seconds > 0:
+			mantissa, exponent = math.frexp(seconds)
+			index = exponent * SUB_BUCKETS + int((mantissa - 0.5) * 2 * SUB_BUCKETS)
+		else:
+			index = None
+		self.buckets[index] = self.buckets.get(index, 0) + 1
+
+	@staticmethod
+	def bucket_value(index):
+		# middle of the bucket
+		if index is None:
+			return 0.
+		exponent, sub = divmod(index, SUB_BUCKETS)
+		return math.ldexp(0.5 + (sub + 0.5) / (2. * SUB_BUCKETS), exponent)
+
+	def percentile(self, p):
+		if self.count == 0:
+			return 0.
+		rank = p / 100. * self.count
+		seen = 0
+		for index in sorted(self.buckets, key=lambda i: -1 if i is None else i):
+			seen += self.buckets[index]
+			if seen >= rank:
+				return min(self.bucket_value(index), self.max)
+		return self.max
+
+	def summary(self):
+		# in milliseconds
+		mean = self.total / self.count if self.count else 0.
+		return {'count': self.count, 'mean_ms': 1000 * mean, 'p50_ms': 1000 * self.percentile(50),
+				'p95_ms': 1000 * self.percentile(95), 'p99_ms': 1000 * self.percentile(99),
+				'max_ms': 1000 * self.max, 'total_s': self.total}
+
+
+class _Timer:
+	# One per stage. A stage is timed by one thread at a time (the start is kept in the timer)
+
+	def __init__(self, histogram):
+		self.histogram = histogram
+		self.start = 0.
+
+	def __enter__(self):
+		self.start = time.perf_counter()
+		return self
+
+	def __exit__(self, *args):
+		self.histogram.record(time.perf_counter() - self.start)
+		return False
+
+
+class _NullTimer:
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		return False
+
+
+NULL_TIMER = _NullTimer()
+
+
+class Instruments:
+	# with instruments.timer('remap'): ... times the stage in its histogram,
+	# instruments.count('dropped') counts an event
+
+	def __init__(self, enabled = False):
+		self.enabled = enabled
+		self.histograms = {}
+		self.counters = {}
+		self.timers = {}
+		self.started = time.perf_counter()
+
+	def timer(self, name):
+		if not self.enabled:
+			return NULL_TIMER
+		timer = self.timers.get(name)
+		if timer is None:
+			timer = self.timers[name] = _Timer(self.histogram(name))
+		return timer
+
+	def histogram(self, name):
+		histogram = self.histograms.get(name)
+		if histogram is None:
+			histogram = self.histograms[name] = Histogram()
+		return histogram
+
+	def record(self, name, seconds):
+		# a duration measured elsewhere (ORB-SLAM call, queue wait...)
+		if self.enabled:
+			self.histogram(name).record(seconds)
+
+	def count(self, name, n = 1):
+		if self.enabled:
+			self.counters[name] = self.counters.get(name, 0) + n
+
+	def reset(self):
+		self.histograms.clear()
+		self.counters.clear()
+		self.timers.clear()
+		self.started = time.perf_counter()
+
+	def report(self):
+		return {'elapsed_s': time.perf_counter() - self.started,
+				'stages': dict((name, h.summary()) for name, h in self.histograms.items()),
+				'counters': dict(self.counters)}
+
+	def export_json(self, path):
+		with open(path, 'w') as report_file:
+			json.dump(self.report(), report_file, indent=2, sort_keys=True)
+
+	def export_csv(self, path):
+		# one row per stage, the counters after them with only a count
+		fields = ['count', 'mean_ms', 'p50_ms', 'p95_ms', 'p99_ms', 'max_ms', 'total_s']
+		report = self.report()
+		with open(path, 'w') as report_file:
+			writer = csv.writer(report_file)
+			writer.writerow(['name'] + fields)
+			for name in sorted(report['stages']):
+				writer.writerow([name] + [report['stages'][name][field] for field in fields])
+			for name in sorted(report['counters']):
+				writer.writerow([name, report['counters'][name]] + [''] * (len(fields) - 1))
+
+	def print_report(self):
+		report = self.report()
+		print("{0:<16} {1:>8} {2:>9} {3:>9} {4:>9} {5:>9} {6:>9}".format(
+			'stage', 'count', 'mean ms', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms'))
+		for name in sorted(report['stages']):
+			s = report['stages'][name]
+			print("{0:<16} {1:>8} {2:>9.3f} {3:>9.3f} {4:>9.3f} {5:>9.3f} {6:>9.3f}".format(
+				name, s['count'], s['mean_ms'], s['p50_ms'], s['p95_ms'], s['p99_ms'], s['max_ms']))
+		for name in sorted(report['counters']):
+			print("{0:<16} {1:>8}".format(name, report['counters'][name]))
+
+
+# shared by the components that are not given any instruments
+DISABLED = Instruments(False)
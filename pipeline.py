@@ -0,0 +1,165 @@
+import time
+import threading
+import queue
+
+
+class _End:
+	# Marker sent through the queues when the source has no more items
+	pass
+
+
+END = _End()
+
+
+class StageQueue:
+	# Bounded queue between two stages. With the 'drop_oldest' policy a full queue throws
+	# away its oldest item so the stages always work on the newest frame (real time),
+	# with 'block' the producer waits and nothing is lost (offline runs)
+
+	def __init__(self, name, maxsize = 2, policy = 'drop_oldest'):
+		if policy not in ('drop_oldest', 'block'):
+			raise ValueError("Unknown queue policy: {0}".format(policy))
+		self.name = name
+		self.queue = queue.Queue(maxsize)
+		self.policy = policy
+		self.dropped = 0
+		self.puts = 0
+		self.depth_sum = 0
+		self.max_depth = 0
+
+	def put(self, item):
+		depth = self.queue.qsize()
+		self.puts += 1
+		self.depth_sum += depth
+		self.max_depth = max(self.max_depth, depth)
+
+		if item is END or self.policy == 'block':
+			self.queue.put(item)
+			return
+		while True:
+			try:
+				self.queue.put_nowait(item)
+				return
+			except queue.Full:
+				try:
+					old = self.queue.get_nowait()
+				except queue.Empty:
+					continue
+				if old is END:
+					# never drop the end marker
+					self.queue.put(old)
+					return
+				self.dropped += 1
+
+	def get(self):
+		return self.queue.get()
+
+	def metrics(self):
+		mean_depth = self.depth_sum / self.puts if self.puts else 0.
+		return {'depth': self.queue.qsize(), 'max_depth': self.max_depth,
+				'mean_depth': mean_depth, 'dropped': self.dropped}
+
+
+class Pipeline:
+	# Runs the stages of the tracking loop on their own threads, connected by bounded queues.
+	# OpenCV releases the GIL so the stages overlap, and the throughput is the one of the
+	# slowest stage instead of the sum of all of them.
+	# A stage is a function item -> item, returning None drops the item.
+
+	def __init__(self, queue_size = 2, policy = 'drop_oldest'):
+		self.queue_size = queue_size
+		self.policy = policy
+		self.stages = []
+		self.queues = []
+		self.threads = []
+		self.busy = {}
+		self.processed = {}
+		self.error = None
+
+	def add_stage(self, name, function):
+		self.stages.append((name, function))
+		return self
+
+	def _source(self, source, num_items):
+		out_queue = self.queues[0]
+		count = 0
+		try:
+			while (num_items is None or count < num_items) and self.error is None:
+				t0 = time.monotonic()
+				item = source()
+				self.busy['source'] += time.monotonic() - t0
+				if item is None:
+					break
+				self.processed['source'] += 1
+				out_queue.put(item)
+				count += 1
+		except Exception as e:
+			self.error = e
+		out_queue.put(END)
+
+	def _worker(self, name, function, in_queue, out_queue):
+		while True:
+			item = in_queue.get()
+			if item is END:
+				break
+			if self.error is not None:
+				continue
+			t0 = time.monotonic()
+			try:
+				item = function(item)
+			except Exception as e:
+				self.error = e
+				continue
+			self.busy[name] += time.monotonic() - t0
+			self.processed[name] += 1
+			if item is not None:
+				out_queue.put(item)
+		out_queue.put(END)
+
+	def run(self, source, sink = None, num_items = None):
+	# source() gives the next item (None when finished), sink(item) is called on the
+	# caller thread with the output of the last stage
+		names = ['source'] + [name for name, _ in self.stages]
+		self.busy = dict((name, 0.) for name in names)
+		self.processed = dict((name, 0) for name in names)
+		self.queues = [StageQueue(name, self.queue_size, self.policy) for name in names]
+		self.threads = [threading.Thread(target=self._source, args=(source, num_items))]
+		for i, (name, function) in enumerate(self.stages):
+			self.threads.append(threading.Thread(target=self._worker,
+												 args=(name, function, self.queues[i], self.queues[i + 1])))
+		for thread in self.threads:
+			thread.daemon = True
+			thread.start()
+
+		outputs = 0
+		while True:
+			item = self.queues[-1].get()
+			if item is END:
+				break
+			outputs += 1
+			if sink is not None:
+				sink(item)
+
+		for thread in self.threads:
+			thread.join()
+		if self.error is not None:
+			raise self.error
+		return outputs
+
+	def metrics(self):
+	# Per stage: items processed, time spent working and the state of its output queue
+		out = {}
+		for i, name in enumerate(['source'] + [name for name, _ in self.stages]):
+			stage = {'processed': self.processed.get(name, 0), 'busy': self.busy.get(name, 0.)}
+			if i < len(self.queues):
+				stage.update(self.queues[i].metrics())
+			out[name] = stage
+		return out
+
+	def print_metrics(self):
+		metrics = self.metrics()
+		for name in ['source'] + [name for name, _ in self.stages]:
+			stage = metrics[name]
+			print("{0:>12} : {1} items, {2:.3f} s busy, queue max {3} mean {4:.2f}, dropped {5}".format(
+				name, stage['processed'], stage['busy'], stage.get('max_depth', 0),
+				stage.get('mean_depth', 0.), stage.get('dropped', 0)))
@@ -0,0 +1,58 @@
+import numpy as np
+
+# Transform of the detections (camera frame) to the world frame of the SLAM. Only the latest
+# pose is kept, so the cost of a frame does not depend on the length of the run; at the end the
+# whole history can be transformed again with the final (optimized) trajectory
+
+
+class PoseTransform:
+
+	def __init__(self):
+		self.pose = np.eye(3, 4)     # camera to world, [R | t]
+		self.t = None                # time of the pose, None before the first one
+		self.out = np.empty((0, 3))
+
+	def set_pose(self, pose, t = None):
+		# pose is the 3x4 matrix or its 12 values row by row (r00 r01 r02 t0 r10 ... t2)
+		self.pose[:] = np.asarray(pose, np.float64).reshape(3, 4)
+		self.t = t
+
+	@staticmethod
+	def supported(slam):
+		# the binding has to give the current pose alone, get_trajectory_points copies the whole
+		# trajectory and would make every frame slower than the previous one
+		return hasattr(slam, 'get_current_pose')
+
+	def update(self, slam):
+		# Latest pose of the SLAM from get_current_pose (camera to world, 3x4 or 4x4, empty while
+		# the tracking is lost), False if it has none
+		pose = slam.get_current_pose()
+		if pose is None or len(pose) == 0:
+			return False
+		self.set_pose(np.asarray(pose)[:3])
+		return True
+
+	def transform(self, points):
+		# k x 3 points of the camera to the world frame with one matmul, the result is a view of a
+		# buffer reused from frame to frame (copy it to keep it)
+		points = np.asarray(points, np.float64).reshape(-1, 3)
+		if self.out.shape[0] < len(points):
+			self.out = np.empty((len(points), 3))
+		out = self.out[:len(points)]
+		np.dot(points, self.pose[:, :3].T, out=out)
+		out += self.pose[:, 3]
+		return out
+
+
+def poses_at(trajectory, times):
+	# 3x4 pose of the trajectory (POSE_DTYPE records) for every time, the latest pose that is not
+	# after it (the first one for the times before the trajectory)
+	index = np.searchsorted(trajectory['t'], times, side='right') - 1
+	return trajectory['pose'][np.clip(index, 0, len(trajectory) - 1)]
+
+
+def retransform(trajectory, times, points):
+	# Batch mode: all the points (N x 3, camera frame, taken at times) with the final trajectory
+	poses = poses_at(trajectory, times)
+	points = np.asarray(points, np.float64).reshape(-1, 3)
+	return np.einsum('nij,nj->ni', poses[:, :, :3], points) + poses[:, :, 3]
@@ -0,0 +1,127 @@
+import cv2 as cv
+import numpy as np
+import hashlib
+import os
+from instrumentation import DISABLED
+
+# Cache of the maps, next to this module whatever the working directory
+MAP_CACHE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Parameters', 'map_cache')
+
+
+def calibration_hash(path, size, fisheye = True):
+	# The key of the cache, it changes if the calibration file, the resolution or the lens model changes
+	sha = hashlib.sha1()
+	with open(path, 'rb') as calib_file:
+		sha.update(calib_file.read())
+	sha.update('{0}x{1}'.format(size[0], size[1]).encode())
+	sha.update(b'fisheye' if fisheye else b'normal')
+	return sha.hexdigest()
+
+
+def build_maps(K, D, R, P, size, fisheye = True):
+	# Build the undistort rectify map and convert it to the fixed point form,
+	# map1 is CV_16SC2 (integer coordinates) and map2 is CV_16UC1 (interpolation table index)
+	if fisheye:
+		map1, map2 = cv.fisheye.initUndistortRectifyMap(K, D, R, P, size, cv.CV_32FC1)
+	else:
+		map1, map2 = cv.initUndistortRectifyMap(K, D, R, P, size, cv.CV_32FC1)
+	return cv.convertMaps(map1, map2, cv.CV_16SC2)
+
+
+def load_or_build_maps(stereo, calib_path, fisheye = True, cache_dir = None):
+	# Returns the fixed point maps (map1l, map2l, map1r, map2r), from the cache (MAP_CACHE by default)
+	# if possible. The cached maps are memory mapped so they are only read from disk when remap touches them
+	if cache_dir is None:
+		cache_dir = MAP_CACHE
+	size = (stereo.w, stereo.h)
+	key = calibration_hash(calib_path, size, fisheye)
+	names = ['map1l', 'map2l', 'map1r', 'map2r']
+	files = [os.path.join(cache_dir, '{0}_{1}.npy'.format(key, name)) for name in names]
+
+	if all(os.path.exists(name) for name in files):
+		return [np.load(name, mmap_mode='r') for name in files]
+
+	map1l, map2l = build_maps(stereo.K_l, stereo.D_l, stereo.R_l, stereo.P_l, size, fisheye)
+	map1r, map2r = build_maps(stereo.K_r, stereo.D_r, stereo.R_r, stereo.P_r, size, fisheye)
+	maps = [map1l, map2l, map1r, map2r]
+
+	if not os.path.isdir(cache_dir):
+		os.makedirs(cache_dir)
+	for name, m in zip(files, maps):
+		# write to a temporary file first so a crash never leaves half a map in the cache
+		tmp = name + '.tmp'
+		with open(tmp, 'wb') as map_file:
+			np.save(map_file, m)
+		os.replace(tmp, name)
+	return maps
+
+
+class Rectifier:
+	# Rectification stage that does not allocate in the loop. The frames are converted to gray
+	# first so only one channel is remapped, the colour image (or a part of it) is only
+	# rectified for the detector. All the outputs are written in buffers reused across frames,
+	# with buffers > 1 the outputs of the last frames stay valid while the new ones are written
+
+	def __init__(self, map1l, map2l, map1r, map2r, buffers = 1, instruments = DISABLED):
+		self.map1l, self.map2l = map1l, map2l
+		self.instruments = instruments
+		self.map1r, self.map2r = map1r, map2r
+		self.h, self.w = map1l.shape[:2]
+		self.slots = [self._allocate() for _ in range(buffers)]
+		self.index = 0
+		self.src_shape = None
+
+	def _allocate(self):
+		return {'gray_l': np.empty((self.h, self.w), np.uint8),
+				'gray_r': np.empty((self.h, self.w), np.uint8),
+				'color_l': np.empty((self.h, self.w, 3), np.uint8),
+				'color_r': np.empty((self.h, self.w, 3), np.uint8),
+				'roi_l': np.empty(self.h*self.w*3, np.uint8)}
+
+	def _source_buffers(self, shape):
+		# the gray versions of the raw frames, their size is the one of the camera
+		if self.src_shape != shape:
+			for slot in self.slots:
+				slot['src_l'] = np.empty(shape[:2], np.uint8)
+				slot['src_r'] = np.empty(shape[:2], np.uint8)
+			self.src_shape = shape
+
+	def next_slot(self):
+		slot = self.slots[self.index]
+		self.index = (self.index + 1) % len(self.slots)
+		return slot
+
+	def rectify(self, left_frame, right_frame, color_left = True, color_right = False, roi = None, gray = True):
+	# Returns the rectified gray images and the rectified colour images asked for.
+	# With roi = (x0, y0, x1, y1) only that part of the left colour image is rectified
+		self._source_buffers(left_frame.shape)
+		slot = self.next_slot()
+
+		imgL, imgR = None, None
+		if gray:
+			with self.instruments.timer('cvtColor'):
+				cv.cvtColor(left_frame, cv.COLOR_BGR2GRAY, dst=slot['src_l'])
+				cv.cvtColor(right_frame, cv.COLOR_BGR2GRAY, dst=slot['src_r'])
+			with self.instruments.timer('remap'):
+				imgL = cv.remap(slot['src_l'], self.map1l, self.map2l, cv.INTER_LINEAR, dst=slot['gray_l'])
+				imgR = cv.remap(slot['src_r'], self.map1r, self.map2r, cv.INTER_LINEAR, dst=slot['gray_r'])
+
+		imgL_color, imgR_color = None, None
+		with self.instruments.timer('remap_color'):
+			if color_left:
+				if roi is None:
+					imgL_color = cv.remap(left_frame, self.map1l, self.map2l, cv.INTER_LINEAR, dst=slot['color_l'])
+				else:
+					imgL_color = self.rectify_roi(left_frame, roi, slot)
+			if color_right:
+				imgR_color = cv.remap(right_frame, self.map1r, self.map2r, cv.INTER_LINEAR, dst=slot['color_r'])
+
+		return imgL, imgR, imgL_color, imgR_color
+
+	def rectify_roi(self, left_frame, roi, slot = None):
+	# The maps hold absolute source coordinates, so a crop of the maps gives a crop of the rectified image
+		if slot is None:
+			slot = self.next_slot()
+		x0, y0, x1, y1 = roi
+		dst = slot['roi_l'][:(y1 - y0)*(x1 - x0)*3].reshape(y1 - y0, x1 - x0, 3)
+		return cv.remap(left_frame, self.map1l[y0:y1, x0:x1], self.map2l[y0:y1, x0:x1], cv.INTER_LINEAR, dst=dst)
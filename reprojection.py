@@ -0,0 +1,42 @@
+import cv2 as cv
+import numpy as np
+
+# Vectorized reprojection of (x, y, disparity) to 3d with the Q matrix of the rectification.
+# The depth gate is the same as the one used for the ball (100 < z < 2000), as a mask
+
+
+def reproject_points(points, Q, min_depth = 100, max_depth = 2000):
+	# points is N x 3 (x, y, disparity), returns the N x 3 float32 coordinates and the mask
+	# of the points inside the depth gate
+	points = np.asarray(points, np.float64).reshape(-1, 3)
+	homogeneous = points.dot(Q[:, :3].T) + Q[:, 3]
+	with np.errstate(divide='ignore', invalid='ignore'):
+		xyz = homogeneous[:, :3] / homogeneous[:, 3:4]
+		mask = (xyz[:, 2] > min_depth) & (xyz[:, 2] < max_depth)
+	return xyz.astype(np.float32), mask
+
+
+def roi_points(disparity, roi = None, min_disparity = 0):
+	# (x, y, disparity) of the valid pixels of a disparity image, or of the roi = (x0, y0, x1, y1)
+	# of it. The disparity can also be the result of the matcher on that roi only (same size)
+	if roi is None:
+		roi = (0, 0, disparity.shape[1], disparity.shape[0])
+	x0, y0, x1, y1 = roi
+	if disparity.shape[:2] != (y1 - y0, x1 - x0):
+		disparity = disparity[y0:y1, x0:x1]
+	ys, xs = np.nonzero(disparity > min_disparity)
+	return np.column_stack((xs + x0, ys + y0, disparity[ys, xs]))
+
+
+def reproject_roi(disparity, Q, roi = None, min_disparity = 0, min_depth = 100, max_depth = 2000):
+	# 3d points of the valid pixels of the roi, N x 3 float32, already gated by depth
+	xyz, mask = reproject_points(roi_points(disparity, roi, min_disparity), Q, min_depth, max_depth)
+	return xyz[mask]
+
+
+def reproject_image(disparity, Q, out = None):
+	# Full image with cv.reprojectImageTo3D, written in out (h x w x 3 float32) when given so
+	# the buffer is reused from frame to frame
+	if out is None:
+		out = np.empty(disparity.shape[:2] + (3,), np.float32)
+	return cv.reprojectImageTo3D(disparity, Q, out, True)
@@ -0,0 +1,108 @@
+import numpy as np
+
+# One tracked sample: time of the frame, 3d position, disparity and radius of the detection, flags
+SAMPLE_DTYPE = np.dtype([('t', 'f8'), ('x', 'f4'), ('y', 'f4'), ('z', 'f4'),
+						 ('disparity', 'f4'), ('radius', 'f4'), ('flags', 'u4')])
+
+FLAG_TRACKED = 1     # the tracker accepted the sample
+FLAG_SPARSE = 2      # the disparity comes from the sparse triangulation
+
+
+class SampleStore:
+	# Preallocated columnar store for the tracked samples, in place of a list of lists.
+	# By default it grows (doubling, so append is O(1) amortized). With circular = True it keeps
+	# the last capacity samples in a buffer written twice (i and i + capacity), so the latest N
+	# samples are always one contiguous view. With spill = path every full block of a circular
+	# store is also appended to that file, for runs of hours with a bounded memory
+
+	def __init__(self, capacity = 4096, circular = False, spill = None, dtype = SAMPLE_DTYPE):
+		self.dtype = np.dtype(dtype)
+		self.capacity = capacity
+		self.circular = circular or spill is not None
+		self.size = 2 * capacity if self.circular else capacity
+		self.buffer = np.zeros(self.size, self.dtype)
+		self.count = 0                  # samples appended since the beginning
+		self.spill = spill
+		self.spilled = 0
+		if spill is not None:
+			open(spill, 'wb').close()
+
+	def __len__(self):
+		return min(self.count, self.capacity) if self.circular else self.count
+
+	def append(self, *values):
+		# values in the order of the fields, the missing ones are 0
+		if len(values) < len(self.dtype.names):
+			values = values + (0,) * (len(self.dtype.names) - len(values))
+		if not self.circular:
+			if self.count == self.capacity:
+				self._grow()
+			self.buffer[self.count] = values
+		else:
+			head = self.count % self.capacity
+			self.buffer[head] = values
+			self.buffer[head + self.capacity] = values
+			if self.spill is not None and head == self.capacity - 1:
+				self._spill()
+		self.count += 1
+
+	def _grow(self):
+		buffer = np.zeros(2 * self.capacity, self.dtype)
+		buffer[:self.capacity] = self.buffer
+		self.buffer = buffer
+		self.capacity *= 2
+		self.size = self.capacity
+
+	def _spill(self):
+		# the block that has just been filled, always contiguous in the second half
+		with open(self.spill, 'ab') as spill_file:
+			self.buffer[self.capacity:].tofile(spill_file)
+		self.spilled += self.capacity
+
+	def latest(self, n = 1):
+		# view (no copy) of the last n samples, oldest first
+		n = min(n, len(self))
+		if not self.circular:
+			return self.buffer[self.count - n:self.count]
+		end = self.count % self.capacity + self.capacity
+		return self.buffer[end - n:end]
+
+	def last(self):
+		# the latest sample, None if there is none
+		if self.count == 0:
+			return None
+		return self.latest(1)[0]
+
+	def samples(self):
+		# view of all the samples in memory, oldest first
+		return self.latest(len(self))
+
+	def __getitem__(self, field):
+		return self.samples()[field]
+
+	def as_array(self, fields = ('t', 'x', 'y', 'z')):
+		# N x len(fields) float array of some fields, like np.array of the old list of lists
+		samples = self.samples()
+		out = np.empty((len(samples), len(fields)))
+		for i, name in enumerate(fields):
+			out[:, i] = samples[name]
+		return out
+
+	def flush(self):
+		# write what has not been spilled yet, to call at the end of the run
+		if self.spill is None:
+			return
+		pending = self.count - self.spilled
+		if pending > 0:
+			with open(self.spill, 'ab') as spill_file:
+				self.latest(pending).tofile(spill_file)
+			self.spilled += pending
+
+	def clear(self):
+		self.count = 0
+		self.spilled = 0
+
+
+def load_spill(path, dtype = SAMPLE_DTYPE):
+	# all the samples spilled to disk, memory mapped
+	return np.memmap(path, dtype=dtype, mode='r')
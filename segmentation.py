@@ -0,0 +1,69 @@
+import cv2 as cv
+import numpy as np
+
+# Colour classes of the targets, HSV ranges of OpenCV (hue 0..179)
+BALL = ('ball', (0, 100, 20), (20, 255, 255))
+GOAL = ('goal', (40, 100, 40), (90, 255, 255))
+
+
+class ColorSegmenter:
+	# Segmentation of any number of colour classes (up to 8) in one pass over the frame. Every
+	# channel of the HSV image goes through a table that gives the bitfield of the classes whose
+	# range contains the value, the AND of the three is the bitfield of the pixel and a last table
+	# turns it into the label (1 + index of the class, 0 for none). The morphology and the connected
+	# components then run on the mask of every label, so a ball touching the goal stays a blob of its own
+
+	def __init__(self, classes = (BALL, GOAL), erode = 1, dilate = 3, min_radius = 10):
+		if len(classes) > 8:
+			raise ValueError("At most 8 colour classes")
+		self.names = [name for name, _, _ in classes]
+		self.erode = erode
+		self.dilate = dilate
+		self.min_radius = min_radius
+		self.luts = np.zeros((3, 256), np.uint8)
+		values = np.arange(256)
+		for i, (_, lower, upper) in enumerate(classes):
+			for channel in range(3):
+				inside = (values >= lower[channel]) & (values <= upper[channel])
+				self.luts[channel, inside] |= 1 << i
+		# label of a bitfield, the first class wins if the ranges overlap
+		self.bit_to_label = np.zeros(256, np.uint8)
+		for bits in range(1, 256):
+			self.bit_to_label[bits] = (bits & -bits).bit_length()
+		self.labels = None
+		self.mask = None
+
+	def label_image(self, image):
+		# label of every pixel of the BGR image
+		hsv = cv.cvtColor(image, cv.COLOR_BGR2HSV)
+		h, s, v = cv.split(hsv)
+		bits = cv.bitwise_and(cv.bitwise_and(cv.LUT(h, self.luts[0]), cv.LUT(s, self.luts[1])), cv.LUT(v, self.luts[2]))
+		return cv.LUT(bits, self.bit_to_label)
+
+	def detect(self, image, labels = None):
+		# (xc, yc, radius) of the largest blob of every class, (0, 0, 0) if there is none.
+		# labels can be given if the label image was computed another way
+		if labels is None:
+			labels = self.label_image(image)
+		self.labels = labels
+		self.mask = None
+		targets = dict((name, (0, 0, 0)) for name in self.names)
+		for index, name in enumerate(self.names):
+			mask = cv.compare(labels, index + 1, cv.CMP_EQ)
+			mask = cv.erode(mask, None, iterations=self.erode)
+			mask = cv.dilate(mask, None, iterations=self.dilate)
+			# union of the classes, for display
+			self.mask = mask if self.mask is None else cv.bitwise_or(self.mask, mask)
+			count, components, stats, _ = cv.connectedComponentsWithStats(mask, connectivity=8)
+			if count <= 1:
+				continue
+			best = 1 + np.argmax(stats[1:, cv.CC_STAT_AREA])
+			x, y, w, h = stats[best, :4]
+			# enclosing circle of the component, only in its bounding box
+			blob = np.where(components[y:y + h, x:x + w] == best, np.uint8(255), np.uint8(0))
+			cnts = cv.findContours(blob, cv.RETR_EXTERNAL, cv.CHAIN_APPROX_SIMPLE)[-2]
+			((cx, cy), radius) = cv.minEnclosingCircle(max(cnts, key=cv.contourArea))
+			if radius > self.min_radius:
+				targets[name] = (int(cx + x), int(cy + y), int(radius))
+		return targets
+
@@ -0,0 +1,339 @@
+import cv2 as cv
+import numpy as np
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from census import CensusMatcher
+
+
+def sgbm_parameters(window_size = 8, minDisparity = 0, a = 8, blockSize = 4, disp12MaxDiff = 50, uniquenessRatio = 3,
+					speckleWindowSize = 5, speckleRange = 2, preFilterCap = 55, mode = cv.STEREO_SGBM_MODE_SGBM_3WAY):
+	# The arguments of cv.StereoSGBM_create, as a dict so the configuration can be sent to other processes
+	return {'minDisparity': -minDisparity,
+			'numDisparities': 16*a,             # max_disp has to be dividable by 16 f. E. HH 192, 256
+			'blockSize': blockSize,
+			'P1': 8 * 3 * window_size ** 2,    # wsize default 3; 5; 7 for SGBM reduced size image; 15 for SGBM full size image (1300px and above); 5 Works nicely
+			'P2': 32 * 3 * window_size ** 2,
+			'disp12MaxDiff': disp12MaxDiff,
+			'uniquenessRatio': uniquenessRatio,
+			'speckleWindowSize': speckleWindowSize,
+			'speckleRange': speckleRange,
+			'preFilterCap': preFilterCap,
+			'mode': mode}
+
+
+def create_matcher(params):
+	return cv.StereoSGBM_create(**params)
+
+
+# The arguments of sgbm_parameters without the mode, the mode comes with the name of the matcher
+SGBM_ARGUMENTS = ('window_size', 'minDisparity', 'a', 'blockSize', 'disp12MaxDiff', 'uniquenessRatio',
+				  'speckleWindowSize', 'speckleRange', 'preFilterCap')
+
+
+def save_matcher_config(path, config, scores = None):
+	# config has the SGBM_ARGUMENTS and 'matcher' (a name of MATCHERS), scores are kept for reference
+	with open(path, 'w') as config_file:
+		json.dump({'config': config, 'scores': scores or {}}, config_file, indent=2, sort_keys=True)
+
+
+def load_matcher_config(path):
+	with open(path) as config_file:
+		config = json.load(config_file)['config']
+	missing = [name for name in SGBM_ARGUMENTS + ('matcher',) if name not in config]
+	if missing:
+		raise ValueError("{0} has no {1}".format(path, ', '.join(missing)))
+	return config
+
+
+def config_parameters(config):
+	# the sgbm_parameters dict of a config
+	return sgbm_parameters(*[config[name] for name in SGBM_ARGUMENTS])
+
+
+class OpenCVMatcher:
+	# An OpenCV matcher (cv.StereoBM, cv.StereoSGBM) behind compute(left, right, roi = None).
+	# gray converts colour images first, StereoBM only takes 8 bit single channel images
+
+	def __init__(self, matcher, gray = False):
+		self.matcher = matcher
+		self.gray = gray
+
+	def compute(self, left, right, roi = None):
+		if roi is not None:
+			x0, y0, x1, y1 = roi
+			left, right = left[y0:y1, x0:x1], right[y0:y1, x0:x1]
+		if self.gray and left.ndim == 3:
+			left, right = cv.cvtColor(left, cv.COLOR_BGR2GRAY), cv.cvtColor(right, cv.COLOR_BGR2GRAY)
+		return self.matcher.compute(left, right)
+
+
+class WLSMatcher:
+	# SGBM of the left and of the right image (cv.ximgproc.createRightMatcher) smoothed by the
+	# edge aware WLS filter with the left image as guide. Needs opencv-contrib-python
+
+	def __init__(self, params, lmbda = 8000., sigma = 1.5):
+		if not hasattr(cv, 'ximgproc'):
+			raise ImportError("The WLS matcher needs cv.ximgproc (opencv-contrib-python)")
+		self.left_matcher = create_matcher(params)
+		self.right_matcher = cv.ximgproc.createRightMatcher(self.left_matcher)
+		self.wls_filter = cv.ximgproc.createDisparityWLSFilter(matcher_left=self.left_matcher)
+		self.wls_filter.setLambda(lmbda)
+		self.wls_filter.setSigmaColor(sigma)
+
+	def compute(self, left, right, roi = None):
+		if roi is not None:
+			x0, y0, x1, y1 = roi
+			left, right = left[y0:y1, x0:x1], right[y0:y1, x0:x1]
+		displ = self.left_matcher.compute(left, right)
+		dispr = self.right_matcher.compute(right, left)
+		return self.wls_filter.filter(displ, left, None, dispr)
+
+
+def _bm_matcher(params):
+	# StereoBM from the SGBM configuration: odd block of at least 5 pixels, prefilter cap up to 63
+	block_size = min(255, max(5, params['blockSize'] | 1))
+	matcher = cv.StereoBM_create(params['numDisparities'], block_size)
+	matcher.setMinDisparity(params['minDisparity'])
+	matcher.setUniquenessRatio(params['uniquenessRatio'])
+	matcher.setSpeckleWindowSize(params['speckleWindowSize'])
+	matcher.setSpeckleRange(params['speckleRange'])
+	matcher.setDisp12MaxDiff(params['disp12MaxDiff'])
+	matcher.setPreFilterCap(min(63, max(1, params['preFilterCap'])))
+	return OpenCVMatcher(matcher, gray = True)
+
+
+def _sgbm_matcher(mode):
+	def factory(params):
+		return OpenCVMatcher(create_matcher(dict(params, mode = mode)))
+	return factory
+
+
+# Matchers by name, all built from the configuration of sgbm_parameters and all with
+# compute(left, right, roi = None) returning the int16 (disparity*16) image of OpenCV
+MATCHERS = {'bm': _bm_matcher,
+			'sgbm': _sgbm_matcher(cv.STEREO_SGBM_MODE_SGBM),
+			'sgbm_hh': _sgbm_matcher(cv.STEREO_SGBM_MODE_HH),
+			'sgbm_hh4': _sgbm_matcher(cv.STEREO_SGBM_MODE_HH4),
+			'sgbm_3way': _sgbm_matcher(cv.STEREO_SGBM_MODE_SGBM_3WAY),
+			'sgbm_wls': WLSMatcher,
+			'census': CensusMatcher}
+
+# Matchers kept for the comparisons only, slower than SGBM even on the band of the ball
+REFERENCE_MATCHERS = ('census',)
+
+
+def register_matcher(name, factory):
+	# factory(params) -> matcher, to add a backend without touching this module
+	MATCHERS[name] = factory
+
+
+def create_stereo_matcher(name, params):
+	if name not in MATCHERS:
+		raise ValueError("Unknown matcher {0}, one of {1}".format(name, ', '.join(sorted(MATCHERS))))
+	return MATCHERS[name](params)
+
+
+def disparity_band(xc, yc, radius, block_size, min_disparity, num_disparities, w, h):
+	# The part of the image the matcher needs to get the disparity around the ball.
+	# Rows are the ball +- (radius + blockSize), the columns are widened to the left by the
+	# disparity range because the matcher looks for the left pixel x at x - d in the right image
+	margin = radius + block_size
+	y0 = max(0, yc - margin)
+	y1 = min(h, yc + margin + 1)
+	x0 = max(0, xc - margin - num_disparities - max(min_disparity, 0))
+	x1 = min(w, xc + margin + 1)
+	return x0, y0, x1, y1
+
+
+def compute_disparity(matcher, imgL, imgR, roi = None):
+	# Disparity in pixels as int16, for the full images or only for roi = (x0, y0, x1, y1).
+	# With a roi the result is the size of the roi, the pixel (x, y) is at [y - y0, x - x0]
+	if roi is not None:
+		x0, y0, x1, y1 = roi
+		imgL = imgL[y0:y1, x0:x1]
+		imgR = imgR[y0:y1, x0:x1]
+	displ = matcher.compute(imgL, imgR).astype(np.float32)/16
+	return np.int16(displ)
+
+
+# A matcher can not be used by two threads at the same time, every worker thread
+# (or process) keeps its own matcher for each configuration
+_local = threading.local()
+
+
+def _strip_matcher(name, params):
+	key = (name,) + tuple(sorted(params.items()))
+	cache = getattr(_local, 'matchers', None)
+	if cache is None:
+		cache = _local.matchers = {}
+	if key not in cache:
+		cache[key] = create_stereo_matcher(name, params)
+	return cache[key]
+
+
+def _compute_strip(name, params, imgL, imgR):
+	return _strip_matcher(name, params).compute(imgL, imgR)
+
+
+# Default rows given to a strip above and below the rows it keeps
+STRIP_OVERLAP = 64
+
+
+def strip_bounds(h, strips, overlap):
+	# (y0, y1) of the rows kept from each strip and (e0, e1) of the rows given to the matcher
+	bounds = []
+	for i in range(strips):
+		y0 = i * h // strips
+		y1 = (i + 1) * h // strips
+		bounds.append((y0, y1, max(0, y0 - overlap), min(h, y1 + overlap)))
+	return bounds
+
+
+class StripDisparity:
+	# Splits the rectified pair in horizontal strips that overlap, runs the same matcher (a name of
+	# MATCHERS) on each strip in a pool and stitches the results. compute() returns the same int16
+	# (disparity*16) image as the matcher, so it can be used instead of left_matcher everywhere.
+	# The result is not exactly the one of the full image: SGBM aggregates the costs along vertical
+	# paths over the whole column and a strip cuts them. A margin of the block size alone changed
+	# 10-50% of the pixels and put 2-10% off by more than 1 px, so the default overlap is a few
+	# times the reach of the aggregation; bench_strips.py gives the rate of the seam error and the
+	# speedup left for an overlap
+
+	def __init__(self, params, strips = 4, overlap = None, workers = None, processes = False, matcher = 'sgbm_3way'):
+		self.params = dict(params)
+		self.matcher = matcher
+		self.strips = strips
+		# the overlap has to cover the block and most of the vertical aggregation of SGBM
+		self.overlap = overlap if overlap is not None else max(STRIP_OVERLAP, 8*params['blockSize'])
+		self.workers = workers if workers is not None else strips
+		self.processes = processes
+		self.executor = None
+
+	def set_parameters(self, params):
+		self.params = dict(params)
+
+	def _pool(self):
+		if self.executor is None:
+			if self.processes:
+				self.executor = ProcessPoolExecutor(self.workers)
+			else:
+				self.executor = ThreadPoolExecutor(self.workers)
+		return self.executor
+
+	def compute(self, imgL, imgR, roi = None):
+		if roi is not None:
+			x0, y0, x1, y1 = roi
+			imgL, imgR = imgL[y0:y1, x0:x1], imgR[y0:y1, x0:x1]
+		h = imgL.shape[0]
+		# small images (a roi) are not worth splitting more than the overlap allows
+		strips = min(self.strips, max(1, h // max(1, self.overlap)))
+		if strips == 1:
+			return _compute_strip(self.matcher, self.params, imgL, imgR)
+
+		bounds = strip_bounds(h, strips, self.overlap)
+		results = self._pool().map(_compute_strip, [self.matcher]*strips, [self.params]*strips,
+								   [imgL[e0:e1] for _, _, e0, e1 in bounds],
+								   [imgR[e0:e1] for _, _, e0, e1 in bounds])
+		disp = np.empty(imgL.shape[:2], np.int16)
+		for (y0, y1, e0, e1), strip in zip(bounds, results):
+			disp[y0:y1] = strip[y0 - e0:y1 - e0]
+		return disp
+
+	def close(self):
+		if self.executor is not None:
+			self.executor.shutdown()
+			self.executor = None
+
+
+def _round16(n):
+	return max(16, 16 * int(np.ceil(n / 16.)))
+
+
+def compare_disparity(reference, disparity, min_disparity = 0):
+	# Error of a disparity (int16, *16) against a reference one, on the pixels valid in both
+	valid_ref = reference >= min_disparity * 16
+	valid = disparity >= min_disparity * 16
+	both = valid_ref & valid
+	error = np.abs(reference[both].astype(np.float32) - disparity[both]) / 16.
+	return {'density_ref': np.mean(valid_ref),
+			'density': np.mean(valid),
+			'mean_error': float(np.mean(error)) if error.size else 0.,
+			'bad_1px': float(np.mean(error > 1)) if error.size else 0.}
+
+
+def right_disparity(matcher, imgL, imgR):
+	# Disparity of the right image with any left matcher: the mirrored right image is matched
+	# against the mirrored left one, the pixel x of the right image matches x + d in the left one
+	return cv.flip(matcher.compute(cv.flip(imgR, 1), cv.flip(imgL, 1)), 1)
+
+
+def left_right_consistency(displ, dispr, min_disparity = 0, threshold = 1.):
+	# Fraction of the valid left pixels whose match in the right image comes back to them
+	# within threshold pixels, and the mask of these pixels
+	h, w = displ.shape
+	valid = displ >= min_disparity * 16
+	d = displ.astype(np.float32) / 16.
+	columns = np.arange(w)[np.newaxis, :] - np.round(d).astype(np.int32)
+	inside = valid & (columns >= 0) & (columns < w)
+	rows = np.nonzero(inside)
+	back = dispr[rows[0], columns[inside]].astype(np.float32) / 16.
+	consistent = np.zeros((h, w), bool)
+	consistent[rows] = (np.abs(back - d[inside]) <= threshold) & (dispr[rows[0], columns[inside]] >= min_disparity * 16)
+	return float(np.count_nonzero(consistent)) / max(1, np.count_nonzero(valid)), consistent
+
+
+class DisparityPrior:
+	# Follows the disparity of the ball from frame to frame and gives the search window of the
+	# next frame: a margin around the prediction (last disparity + last change) instead of the
+	# full range. The window gets wider when the ball is lost or the measure is on the border of
+	# the window, and goes back to the full range after max_lost frames without a measure
+
+	def __init__(self, min_disparity, num_disparities, margin = 8, max_lost = 3):
+		self.min_disparity = min_disparity
+		self.num_disparities = num_disparities
+		self.margin = margin
+		self.max_lost = max_lost
+		self.disparity = None
+		self.velocity = 0.
+		self.lost = 0
+		self.widen = 1
+		self.low, self.num = min_disparity, num_disparities
+
+	def reset(self):
+		self.disparity = None
+		self.velocity = 0.
+		self.lost = 0
+		self.widen = 1
+
+	def window(self):
+		# (minDisparity, numDisparities) to use for the next frame
+		max_disp = self.min_disparity + self.num_disparities
+		if self.disparity is None:
+			self.low, self.num = self.min_disparity, self.num_disparities
+			return self.low, self.num
+		predicted = self.disparity + self.velocity
+		margin = self.margin * self.widen + abs(self.velocity)
+		low = int(max(self.min_disparity, np.floor(predicted - margin)))
+		num = min(_round16(2 * margin), self.num_disparities)
+		low = min(low, max_disp - num)
+		self.low, self.num = low, num
+		return low, num
+
+	def update(self, disparity):
+		# disparity measured with the last window, None when there is no ball or no match
+		if disparity is None or disparity < self.low or disparity >= self.low + self.num:
+			self.lost += 1
+			self.widen = min(self.widen * 2, 8)
+			if self.lost > self.max_lost:
+				self.reset()
+			return
+		if self.disparity is not None and self.lost == 0:
+			self.velocity = disparity - self.disparity
+		else:
+			self.velocity = 0.
+		# a measure on the border of the window may be clipped, keep the window wide
+		on_border = self.num < self.num_disparities and (disparity <= self.low + 1 or disparity >= self.low + self.num - 2)
+		self.widen = 2 if on_border else 1
+		self.disparity = float(disparity)
+		self.lost = 0
@@ -0,0 +1,154 @@
+import numpy as np
+
+# 99% quantiles of the chi-square distribution, for the Mahalanobis gates
+CHI2_99 = {1: 6.63, 2: 9.21, 3: 11.34}
+
+
+class KalmanCA:
+	# Constant acceleration Kalman filter, the state is (position, velocity, acceleration) for
+	# every dimension and only the position is measured. For a ball in flight the acceleration
+	# is the gravity, so the model is the ballistic one
+
+	def __init__(self, dims, process_noise, measurement_noise):
+		self.dims = dims
+		self.q = process_noise          # spectral density of the jerk
+		self.R = np.eye(dims) * measurement_noise ** 2
+		self.H = np.hstack((np.eye(dims), np.zeros((dims, 2 * dims))))
+		self.x = None
+		self.P = None
+
+	def initialize(self, position, position_std, velocity_std, acceleration_std):
+		self.x = np.zeros(3 * self.dims)
+		self.x[:self.dims] = position
+		self.P = np.diag(np.repeat([position_std ** 2, velocity_std ** 2, acceleration_std ** 2], self.dims))
+
+	def predict(self, dt):
+		I = np.eye(self.dims)
+		F = np.block([[I, dt * I, 0.5 * dt ** 2 * I],
+					  [0 * I, I, dt * I],
+					  [0 * I, 0 * I, I]])
+		q = self.q * np.array([[dt ** 5 / 20., dt ** 4 / 8., dt ** 3 / 6.],
+							   [dt ** 4 / 8., dt ** 3 / 3., dt ** 2 / 2.],
+							   [dt ** 3 / 6., dt ** 2 / 2., dt]])
+		self.x = F.dot(self.x)
+		self.P = F.dot(self.P).dot(F.T) + np.kron(q, I)
+
+	def position(self):
+		return self.x[:self.dims]
+
+	def position_std(self):
+		return np.sqrt(np.diag(self.P)[:self.dims])
+
+	def mahalanobis(self, z):
+		# squared distance of the measure to the prediction, with the innovation covariance
+		y = np.asarray(z, np.float64) - self.H.dot(self.x)
+		S = self.H.dot(self.P).dot(self.H.T) + self.R
+		return y.dot(np.linalg.solve(S, y)), y, S
+
+	def update(self, z, gate = None):
+		# returns False (and ignores the measure) if it is outside the gate
+		d2, y, S = self.mahalanobis(z)
+		if gate is not None and d2 > gate:
+			return False
+		K = np.linalg.solve(S, self.H.dot(self.P)).T
+		self.x = self.x + K.dot(y)
+		self.P = (np.eye(3 * self.dims) - K.dot(self.H)).dot(self.P)
+		return True
+
+
+class BallTracker:
+	# Tracks the ball in the image (pixels) and in 3d at the same time. The image track gives the
+	# window where the ball has to be searched in the next frame (detector and disparity roi), both
+	# tracks reject the measures too far from the prediction, and the ball is kept (coasting) for
+	# max_coast frames without measure before the track is dropped
+
+	def __init__(self, w = 640, h = 480, image_noise = (3000., 2.), world_noise = (20000., 15.),
+				 max_coast = 5, window_sigma = 3., min_margin = 8):
+		self.w, self.h = w, h
+		self.image = KalmanCA(2, image_noise[0], image_noise[1])
+		self.world = KalmanCA(3, world_noise[0], world_noise[1])
+		self.image_noise = image_noise
+		self.world_noise = world_noise
+		self.max_coast = max_coast
+		self.window_sigma = window_sigma
+		self.min_margin = min_margin
+		self.radius = 0.
+		self.t_image = None
+		self.t_world = None
+		self.missed = 0
+		self.world_missed = 0
+		self.rejected = 0
+
+	def tracking(self):
+		return self.image.x is not None
+
+	def reset(self):
+		self.image.x = None
+		self.world.x = None
+		self.t_image = None
+		self.t_world = None
+		self.missed = 0
+		self.world_missed = 0
+		self.radius = 0.
+
+	def predict(self, t):
+		# Move the tracks to the time t of the new frame and return the search window
+		# (x0, y0, x1, y1) of the ball, None when there is no track (search the full image)
+		if self.world.x is not None:
+			self.world.predict(t - self.t_world)
+			self.t_world = t
+		if self.image.x is None:
+			return None
+		self.image.predict(t - self.t_image)
+		self.t_image = t
+		u, v = self.image.position()
+		su, sv = self.image.position_std()
+		mx = self.radius * 1.5 + self.window_sigma * su + self.min_margin
+		my = self.radius * 1.5 + self.window_sigma * sv + self.min_margin
+		x0, y0 = int(max(0, u - mx)), int(max(0, v - my))
+		x1, y1 = int(min(self.w, u + mx + 1)), int(min(self.h, v + my + 1))
+		if x1 - x0 < 2 or y1 - y0 < 2:
+			# the prediction left the image
+			self.reset()
+			return None
+		return x0, y0, x1, y1
+
+	def update_image(self, xc, yc, radius, t):
+		# Measure of the detector (xc, yc = 0 if nothing was found), returns True if it is accepted
+		if not (xc > 0 and yc > 0):
+			self.miss()
+			return False
+		if self.image.x is None:
+			self.image.initialize((xc, yc), self.image_noise[1], 500., 2000.)
+			self.t_image = t
+		elif not self.image.update((xc, yc), CHI2_99[2]):
+			self.rejected += 1
+			self.miss()
+			return False
+		self.radius = radius if self.radius == 0 else 0.7 * self.radius + 0.3 * radius
+		self.missed = 0
+		return True
+
+	def update_world(self, xyz, t):
+		# 3d measure, returns True if it is accepted
+		if self.world.x is None:
+			self.world.initialize(xyz, self.world_noise[1], 3000., 10000.)
+			self.t_world = t
+			return True
+		if not self.world.update(xyz, CHI2_99[3]):
+			self.rejected += 1
+			self.world_missed += 1
+			if self.world_missed > self.max_coast:
+				# the track itself is wrong, start again from this measure
+				self.world.initialize(xyz, self.world_noise[1], 3000., 10000.)
+				self.t_world = t
+				self.world_missed = 0
+				return True
+			return False
+		self.world_missed = 0
+		return True
+
+	def miss(self):
+		self.missed += 1
+		if self.missed > self.max_coast:
+			self.reset()
@@ -0,0 +1,187 @@
+import cv2 as cv
+import numpy as np
+import argparse
+import itertools
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from disparity_fisheye import Stereo
+from stereo_matching import SGBM_ARGUMENTS, create_stereo_matcher, config_parameters, save_matcher_config, \
+	right_disparity, left_right_consistency, compare_disparity
+from bench_strips import load_pairs
+from bench_matchers import synthetic_pairs
+from frame_source import SessionSource
+
+# Offline search of the matcher configuration, in place of the trackbars of Test_BM.py. Every
+# configuration runs on the same rectified pairs in a process pool (one OpenCV thread per process
+# so the times can be compared) and is scored on the time per frame and on the quality: fraction
+# of the pixels without a left-right consistent disparity and, with a known disparity (synthetic
+# pairs or --truth), fraction of the pixels wrong by more than 1 px. The Pareto front of these
+# objectives is printed and the fastest configuration of the front within --max-error is written
+# for Stereo.load_matcher_parameters. Run from the root of the repository:
+#   python tune_sgbm.py --samples 200 --params Parameters/sgbm_params.json
+#   python tune_sgbm.py --synthetic 10 --samples 100 --workers 4
+
+# Values tried for every argument of sgbm_parameters and for the matcher
+SEARCH_SPACE = {'matcher': ['sgbm', 'sgbm_hh4', 'sgbm_3way'],
+				'window_size': [3, 5, 7, 8, 11],
+				'minDisparity': [0],
+				'a': [4, 6, 8],
+				'blockSize': [3, 4, 5, 7, 9],
+				'disp12MaxDiff': [1, 10, 50],
+				'uniquenessRatio': [1, 3, 5, 10],
+				'speckleWindowSize': [0, 5, 50, 100],
+				'speckleRange': [1, 2],
+				'preFilterCap': [15, 31, 55]}
+
+# the pairs of the worker process, sent once by the initializer instead of with every configuration
+_pairs = None
+_truths = None
+
+
+def _init_worker(pairs, truths, cv_threads):
+	global _pairs, _truths
+	_pairs, _truths = pairs, truths
+	cv.setNumThreads(cv_threads)
+
+
+def evaluate_config(config, repeat = 2):
+	# scores of one configuration on the pairs of the worker
+	params = config_parameters(config)
+	matcher = create_stereo_matcher(config['matcher'], params)
+	min_disparity = params['minDisparity']
+	disparities = [matcher.compute(imgL, imgR) for imgL, imgR in _pairs]    # also the warm up
+	t0 = time.perf_counter()
+	for _ in range(repeat):
+		for imgL, imgR in _pairs:
+			matcher.compute(imgL, imgR)
+	elapsed = (time.perf_counter() - t0) / (repeat * len(_pairs))
+
+	density, consistent = [], []
+	for (imgL, imgR), displ in zip(_pairs, disparities):
+		_, mask = left_right_consistency(displ, right_disparity(matcher, imgL, imgR), min_disparity)
+		density.append(np.mean(displ >= min_disparity * 16))
+		consistent.append(np.mean(mask))
+	scores = {'ms': 1000 * elapsed, 'density': float(np.mean(density)),
+			  'inconsistent': 1. - float(np.mean(consistent))}
+	if _truths is not None:
+		errors = [compare_disparity(truth, displ, min_disparity) for truth, displ in zip(_truths, disparities)]
+		# the pixels without a disparity count as wrong, a sparse map is not a good one
+		scores['bad_1px'] = float(np.mean([1. - e['density'] + e['density'] * e['bad_1px'] for e in errors]))
+		scores['mean_error'] = float(np.mean([e['mean_error'] for e in errors]))
+	return scores
+
+
+def sample_configs(space, samples, seed = 0, include = ()):
+	# samples configurations drawn without repetition from the grid (all of it if it is smaller),
+	# the configurations of include first
+	names = sorted(space)
+	size = int(np.prod([len(space[name]) for name in names]))
+	rng = np.random.RandomState(seed)
+	if size <= samples:
+		chosen = itertools.product(*[space[name] for name in names])
+		configs = [dict(zip(names, values)) for values in chosen]
+	else:
+		configs = []
+		for index in rng.choice(size, samples, replace=False):
+			config = {}
+			for name in names:
+				index, position = divmod(int(index), len(space[name]))
+				config[name] = space[name][position]
+			configs.append(config)
+	return list(include) + [config for config in configs if config not in include]
+
+
+def pareto_front(results, objectives):
+	# indexes of the results not dominated on the objectives (all minimized), by time
+	front = []
+	for i, result in enumerate(results):
+		dominated = False
+		for j, other in enumerate(results):
+			if j != i and all(other[o] <= result[o] for o in objectives) and any(other[o] < result[o] for o in objectives):
+				dominated = True
+				break
+		if not dominated:
+			front.append(i)
+	return sorted(front, key=lambda i: results[i]['ms'])
+
+
+def choose(results, front, quality, max_error):
+	# fastest of the front within max_error on the quality objective, the best quality otherwise
+	accepted = [i for i in front if results[i][quality] <= max_error]
+	if accepted:
+		return accepted[0]
+	return min(front, key=lambda i: results[i][quality])
+
+
+def load_frames(args, stereo):
+	# rectified gray pairs and their known disparities (int16, *16) or None
+	if args.synthetic:
+		return synthetic_pairs(args.synthetic, stereo.w, stereo.h, config_parameters(stereo.matcher_config()))
+	stereo.Initialize_mapping_calibration(disparity_bool = False)
+	if os.path.exists(os.path.join(args.images, 'session.json')):
+		session = SessionSource(args.images)
+		pairs = []
+		for _ in range(min(len(session), args.pairs)):
+			_, left, right = session.read()
+			imgL, imgR, _, _ = stereo.rectifier.rectify(left, right, color_left = False)
+			pairs.append((imgL.copy(), imgR.copy()))
+	else:
+		pairs = load_pairs(args.images, args.pairs, stereo)
+	truths = None
+	if args.truth:
+		# disparities in pixels of the rectified left images, one per pair
+		truths = [np.int16(16 * d) for d in np.load(args.truth)['disparity'][:len(pairs)]]
+	return pairs, truths
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--images', default='Calibration/Fisheye/Images_calibration',
+						help='folder with left_*.png / right_*.png or a recorded session')
+	parser.add_argument('--calibration', default='Parameters/fish_final_calib.npz')
+	parser.add_argument('--pairs', type=int, default=10)
+	parser.add_argument('--synthetic', type=int, default=0, help='number of synthetic pairs with a known disparity instead of the images')
+	parser.add_argument('--truth', default=None, help='npz with the known disparities (pixels) of the pairs in "disparity"')
+	parser.add_argument('--samples', type=int, default=200, help='configurations tried, the whole grid if it is smaller')
+	parser.add_argument('--seed', type=int, default=0)
+	parser.add_argument('--repeat', type=int, default=2)
+	parser.add_argument('--workers', type=int, default=None, help='processes, all the cores by default')
+	parser.add_argument('--cv-threads', type=int, default=1, help='OpenCV threads of every process')
+	parser.add_argument('--max-error', type=float, default=0.3, help='maximum of the quality objective of the chosen configuration')
+	parser.add_argument('--params', default='Parameters/sgbm_params.json', help='file of the chosen configuration')
+	parser.add_argument('--output', default=None, help='json with the scores of every configuration')
+	args = parser.parse_args()
+
+	stereo = Stereo(args.calibration)
+	pairs, truths = load_frames(args, stereo)
+	if not pairs:
+		raise SystemExit("No left_*.png / right_*.png pairs in {0}".format(args.images))
+	# the current configuration of Stereo first, to compare with
+	configs = sample_configs(SEARCH_SPACE, args.samples, args.seed, [stereo.matcher_config()])
+	print("{0} configurations on {1} pairs {2}x{3}".format(len(configs), len(pairs), pairs[0][0].shape[1], pairs[0][0].shape[0]))
+
+	start = time.time()
+	with ProcessPoolExecutor(args.workers, initializer=_init_worker, initargs=(pairs, truths, args.cv_threads)) as pool:
+		scores = list(pool.map(evaluate_config, configs, [args.repeat] * len(configs)))
+	print("Searched in {0:.1f} s".format(time.time() - start))
+
+	results = [dict(score, config=config) for config, score in zip(configs, scores)]
+	quality = 'bad_1px' if truths is not None else 'inconsistent'
+	front = pareto_front(results, ('ms', quality))
+	print("{0:>10} {1:>8} {2:>13} {3:>9}  configuration".format('ms/frame', 'density', quality, 'current'))
+	for i in front:
+		r = results[i]
+		print("{0:>10.2f} {1:>7.1f}% {2:>12.1f}% {3:>9}  {4}".format(
+			r['ms'], 100*r['density'], 100*r[quality], 'yes' if i == 0 else '',
+			' '.join('{0}={1}'.format(name, r['config'][name]) for name in ('matcher',) + SGBM_ARGUMENTS)))
+
+	best = results[choose(results, front, quality, args.max_error)]
+	scores = dict((key, value) for key, value in best.items() if key != 'config')
+	save_matcher_config(args.params, best['config'], scores)
+	print("Chosen: {0:.2f} ms/frame, {1} {2:.1%}, written to {3}".format(best['ms'], quality, best[quality], args.params))
+
+	if args.output:
+		with open(args.output, 'w') as output_file:
+			json.dump({'objectives': ['ms', quality], 'front': front, 'results': results}, output_file, indent=2)